@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# Runs the daemon scheduler in the foreground with a fake clock and a SynchronousExecutor.
+#
+#   python benchmarks/daemon_schedule.py [fake seconds]
+#
+# Without jitter the job runs are checked against the expected counts, including a failing job and a config reload
+# that changes an interval halfway. With jitter the same seeded run is repeated and has to give the same result every
+# time. Runs against a throwaway storage in a temporary directory and exits with 1 if a check fails.
+import asyncio
+import contextlib
+import io
+import os
+import random
+import sys
+import tempfile
+
+CONFIG = """
+borgcube_executable: '/usr/local/bin/borgcube'
+authorized_keys_file: './authorized_keys'
+storage_path: './storage'
+username: 'borg'
+admin_contact: 'borg <borg@example.net>'
+notification_mail: 'borgcube@example.net'
+daemon_jitter: {jitter}
+daemon_ingest_interval: {fast}
+daemon_usage_interval: 60
+daemon_event_interval: 30
+"""
+
+
+def write_config(jitter=0.0, fast=10):
+    with open('config.yaml', 'w') as f:
+        f.write(CONFIG.format(jitter=jitter, fast=fast))
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def run(duration: int, jitter: float, seed: int = 0, reload_at: int = None):
+    # Returns the fake times every job ran at
+    from borgcube.backend import config
+    from borgcube.backend.daemon import Job, Scheduler, SynchronousExecutor
+
+    write_config(jitter)
+    config.reload()
+    runs = {'fast': [], 'slow': [], 'failing': []}
+    clock = FakeClock()
+
+    def job(name):
+        def func():
+            runs[name].append(clock.now)
+            if name == 'failing':
+                raise RuntimeError('failing job')
+        return func
+
+    jobs = [Job('fast', job('fast'), 'daemon_ingest_interval'),
+            Job('slow', job('slow'), 'daemon_usage_interval'),
+            Job('failing', job('failing'), 'daemon_event_interval')]
+    scheduler = None
+
+    async def sleep(seconds):
+        # Started jobs finish at the current time, then the clock jumps
+        while scheduler.tasks:
+            await asyncio.gather(*scheduler.tasks)
+        clock.now += seconds
+        if reload_at is not None and clock.now >= reload_at and clock.now - seconds < reload_at:
+            write_config(jitter, fast=20)
+            scheduler.request_reload()
+        if clock.now >= duration:
+            scheduler.stop()
+
+    scheduler = Scheduler(jobs, clock=clock, sleep=sleep, rand=random.Random(seed).random,
+                          executor=SynchronousExecutor())
+    loop = asyncio.new_event_loop()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            loop.run_until_complete(scheduler.run())
+    finally:
+        loop.close()
+    return runs
+
+
+def expected_runs(start, stop, interval):
+    return list(range(start, stop, interval))
+
+
+def main():
+    duration = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    reload_at = duration // 2
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        write_config()
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+        runs = run(duration, 0.0, reload_at=reload_at)
+        # Before the reload every job runs at multiples of its interval, the reload reschedules all of them
+        expected = {
+            'fast': expected_runs(0, reload_at, 10) + expected_runs(reload_at + 20, duration, 20),
+            'slow': expected_runs(0, reload_at, 60) + expected_runs(reload_at + 60, duration, 60),
+            'failing': expected_runs(0, reload_at, 30) + expected_runs(reload_at + 30, duration, 30),
+        }
+        for name, times in runs.items():
+            ok = times == expected[name]
+            failed |= not ok
+            print(f"{name:<8} {len(times):>4} runs{'' if ok else f', expected {len(expected[name])}: {times}'}")
+
+        counts = [tuple(len(times) for times in run(duration, 0.1, seed=42).values()) for _ in range(4)]
+        print(f"with jitter: {', '.join(str(count) for count in counts)}")
+        if len(set(counts)) != 1:
+            print("runs with the same seed differ")
+            failed = True
+        os.chdir('/')
+    if failed:
+        sys.exit(1)
+    print("ok")
+
+
+if __name__ == '__main__':
+    main()
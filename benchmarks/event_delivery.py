@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# Checks event delivery against a local HTTP server.
+#
+#   python benchmarks/event_delivery.py
+#
+# One webhook answers 500 and then 200, another one always 500. With a fake clock the event has to be delivered to
+# the first webhook once, be retried only for the second one with exponential backoff and move to failed/ after
+# max_attempts. Also checks that an outbox without explicit flags follows a config reload. Runs in a temporary
+# directory and exits with 1 if a check fails.
+import http.server
+import os
+import sys
+import tempfile
+import threading
+
+CONFIG = """
+borgcube_executable: '/usr/local/bin/borgcube'
+authorized_keys_file: './authorized_keys'
+storage_path: './storage'
+username: 'borg'
+admin_contact: 'borg <borg@example.net>'
+notification_mail: 'borgcube@example.net'
+"""
+
+requests = []
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        requests.append(self.path)
+        status = 200 if self.path == '/flaky' and requests.count('/flaky') > 1 else 500
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def check(name, actual, expected) -> bool:
+    ok = actual == expected
+    print(f"{name}: {actual}{'' if ok else f', expected {expected}'}")
+    return not ok
+
+
+def main():
+    failed = False
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f'http://127.0.0.1:{server.server_address[1]}'
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        with open('config.yaml', 'w') as f:
+            f.write(CONFIG)
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        from borgcube.backend import config
+        from borgcube.backend.events import Outbox, EventDispatcher, WebhookTarget
+        from borgcube.enum import EventType
+
+        outbox = Outbox('outbox', 'test', enabled=True)
+        outbox.create_if_needed()
+        outbox.emit(EventType.REPO_QUOTA_CHANGED, {'user': 'alice', 'repo': 'alice_laptop'})
+        clock = FakeClock()
+        flaky, broken = WebhookTarget(f'{base}/flaky', 5), WebhookTarget(f'{base}/broken', 5)
+        dispatcher = EventDispatcher(outbox, [flaky, broken], max_attempts=4, backoff=60, max_backoff=200,
+                                     clock=clock)
+
+        next_attempts = []
+        for now in (0, 30, 60, 180, 379, 380):
+            clock.now = now
+            dispatcher.dispatch_once()
+            pending = outbox.pending()
+            if pending:
+                next_attempts.append(pending[0].record['next_attempt'])
+        failed |= check("requests", requests, ['/flaky', '/broken', '/flaky', '/broken', '/broken', '/broken'])
+        failed |= check("next attempts", sorted(set(next_attempts)), [60, 180, 380])
+        events = outbox.failed()
+        failed |= check("failed events", len(events), 1)
+        if events:
+            failed |= check("delivered to", events[0].delivered, [flaky.name])
+            failed |= check("attempts", events[0].attempts, 4)
+
+        with open('config.yaml', 'a') as f:
+            f.write(f"event_webhooks: ['{base}/flaky']\n")
+        default_outbox = Outbox('outbox')
+        before = default_outbox.enabled
+        config.reload()
+        failed |= check("enabled before and after adding a webhook", (before, default_outbox.enabled), (False, True))
+        server.shutdown()
+        os.chdir('/')
+    if failed:
+        sys.exit(1)
+    print("ok")
+
+
+if __name__ == '__main__':
+    main()
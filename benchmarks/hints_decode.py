@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# Compares reading storage_quota_use from a borg hints file with a full msgpack.unpack and with read_hints.
+#
+#   python benchmarks/hints_decode.py [segments] [rounds]
+#
+# Writes a hints file shaped like the one of a big repository (one entry per segment in 'segments' and 'compact') to a
+# temporary directory and prints time per read and peak allocated memory of both readers.
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from borg.helpers import msgpack  # noqa: E402
+from borgcube.backend.storage import read_hints  # noqa: E402
+
+KEY = b'storage_quota_use'
+
+
+def write_hints(path, segments):
+    hints = {
+        b'version': 2,
+        b'segments': {i: 1000 + i % 500 for i in range(segments)},
+        b'compact': {i: i % 4096 for i in range(segments)},
+        KEY: segments * 500 * 1000 * 1000,
+        b'shadow_index': {},
+    }
+    with open(path, 'wb') as f:
+        msgpack.pack(hints, f)
+
+
+def full_unpack(path):
+    with open(path, 'rb') as fd:
+        return msgpack.unpack(fd)[KEY]
+
+
+def streaming(path):
+    return read_hints(path, [KEY])[KEY]
+
+
+def measure(func, path, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        value = func(path)
+    elapsed = (time.perf_counter() - start) / rounds
+    tracemalloc.start()
+    func(path)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return value, elapsed, peak
+
+
+def main():
+    segments = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'hints.1')
+        write_hints(path, segments)
+        print(f"hints file: {segments} segments, {os.path.getsize(path) / 1000 / 1000:.1f} MB")
+        print(f"{'READER':<16}{'MS PER READ':<14}{'PEAK MEMORY'}")
+        results = {}
+        for name, func in (('msgpack.unpack', full_unpack), ('read_hints', streaming)):
+            value, elapsed, peak = measure(func, path, rounds)
+            results[name] = value
+            print(f"{name:<16}{elapsed * 1000:<14.1f}{peak / 1000:.0f} kB")
+    if len(set(results.values())) != 1:
+        print(f"Readers disagree: {results}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# Checks the schema migrations and the writes that depend on the column types.
+#
+#   python benchmarks/migrations.py
+#
+# Creates the schema of the first release and of the last release without schema versions, migrates both to the
+# latest version and compares them with a freshly created database. Then writes quotas and usage samples beyond 32 bit
+# and compacts the samples. Runs against SQLite in a temporary directory, set BORGCUBE_DATABASE_URL to run against
+# PostgreSQL instead. All tables of that database are dropped. Exits with 1 if a check fails.
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+CONFIG = """
+borgcube_executable: '/usr/local/bin/borgcube'
+authorized_keys_file: './authorized_keys'
+storage_path: './storage'
+username: 'borg'
+admin_contact: 'borg <borg@example.net>'
+notification_mail: 'borgcube@example.net'
+"""
+
+KEY = 'ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIJ4ezW3dGLrQ0LNvLhtm+KvBdL4Q8JL0x2VpScChtzDL benchmark'
+BIG = 5 * 1000 ** 4  # 5 TB, beyond a 32 bit integer
+
+
+def reset(model):
+    from peewee import PostgresqlDatabase
+    cascade = ' CASCADE' if isinstance(model._db.obj, PostgresqlDatabase) else ''
+    for table in model._db.get_tables():
+        model._db.execute_sql(f'DROP TABLE IF EXISTS "{table}"{cascade}')
+
+
+def first_release(model):
+    # The tables as the first release created them
+    from peewee import CharField, IntegerField, SmallIntegerField, BooleanField, ForeignKeyField
+    user = model._table('user', dict(
+        model._lockable_fields(), name=CharField(unique=True), email=CharField(unique=True),
+        max_repo_count=SmallIntegerField(default=10), quota=IntegerField(default=500),
+        ssh_key=model.SSHKeyField(null=True), backup_ssh_key=model.SSHKeyField(null=True)))
+    repo = model._table('repository', dict(
+        model._lockable_fields(), name=CharField(unique=True), user=ForeignKeyField(user, backref='+'),
+        quota=IntegerField(default=500), last_session_success=BooleanField(default=True),
+        append_ssh_key=model.SSHKeyField(null=True), rw_ssh_key=model.SSHKeyField(null=True),
+        max_age=model.TimeDeltaField(default=datetime.timedelta(days=7))))
+    return [user, repo, model._log_table('user_log', dict(user=ForeignKeyField(user, backref='+'))),
+            model._log_table('repo_log', dict(repo=ForeignKeyField(repo, backref='+'))),
+            model._log_table('admin_log', {})]
+
+
+def populate_old(model, tables):
+    user, repo, _, repo_log = tables[:4]
+    user_id = user.insert(name='old', email='old@example.net', ssh_key=KEY).execute()
+    created = datetime.datetime(2020, 1, 1)
+    backed_up = repo.insert(name='old_backed_up', user=user_id, creation_date=created).execute()
+    repo.insert(name='old_never', user=user_id, creation_date=created).execute()
+    repo_log.insert(repo=backed_up, operation=model.LogOperation.SERVE_MODIFY_SUCCESS, data='old',
+                    date=datetime.datetime(2021, 1, 1)).execute()
+
+
+def schema(model):
+    db = model._db
+    result = {}
+    for table in sorted(db.get_tables()):
+        columns = sorted((column.name, column.data_type.lower(), column.null, column.primary_key)
+                         for column in db.get_columns(table))
+        indexes = sorted((tuple(map(str, index.columns)), index.unique) for index in db.get_indexes(table))
+        foreign_keys = sorted((fk.column, fk.dest_table, fk.dest_column) for fk in db.get_foreign_keys(table))
+        result[table] = (columns, indexes, foreign_keys)
+    return result
+
+
+def compare(name, expected, actual):
+    failed = False
+    for table in sorted(set(expected) | set(actual)):
+        if expected.get(table) != actual.get(table):
+            print(f"{name}: table {table} differs\n  fresh:    {expected.get(table)}\n  migrated: {actual.get(table)}")
+            failed = True
+    return failed
+
+
+def check_old_data(model):
+    failed = False
+    repos = {repo.name: repo for repo in model.Repository.select()}
+    last_success = {'old_backed_up': datetime.datetime(2021, 1, 1), 'old_never': datetime.datetime(2020, 1, 1)}
+    for name, date in last_success.items():
+        next_due_at = date + repos[name].max_age
+        if repos[name].next_due_at != next_due_at:
+            print(f"backfill: {name} is due at {repos[name].next_due_at}, expected {next_due_at}")
+            failed = True
+    return failed
+
+
+def check_writes(model):
+    failed = False
+    user = model.User.create(name='big', email='big@example.net', _ssh_key=KEY, quota=BIG)
+    repo = model.Repository.create(name='big_repo', user=user, _quota=BIG, quota_pending=True, backup_slot=1380)
+    with model._write_transaction(f'user:{user.id}'):
+        _, allocated = model.Repository.get_allocation(user)
+    if allocated != BIG or model.User.get_by_id(user.id).quota != BIG:
+        print(f"quota: allocated {allocated}, expected {BIG}")
+        failed = True
+
+    now = int(time.time())
+    # Start of a day, so all samples fall into one daily bucket
+    old = now - now % 86400 - 100 * 86400
+    model.UsageSample.insert_many([{'repo': repo.id, 'timestamp': old + i * 600, 'bytes_used': BIG + i}
+                                   for i in range(6)]).execute()
+    model.UsageSample.compact()
+    samples = list(model.UsageSample.select().where(model.UsageSample.repo == repo.id))
+    if len(samples) != 1 or samples[0].resolution != model.UsageSample.DAILY \
+            or not BIG <= samples[0].bytes_used <= BIG + 5:
+        print(f"usage samples: {[(sample.resolution, sample.bytes_used) for sample in samples]} after compact")
+        failed = True
+    return failed
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        with open('config.yaml', 'w') as f:
+            f.write(CONFIG)
+            if os.environ.get('BORGCUBE_DATABASE_URL'):
+                f.write(f"database_url: '{os.environ['BORGCUBE_DATABASE_URL']}'\n")
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        from borgcube.backend import model
+
+        print(f"database: {type(model._db.obj).__name__}, schema version {len(model.MIGRATIONS)}")
+        reset(model)
+        model.migrate_database()
+        fresh = schema(model)
+
+        failed = False
+        for name, tables in [('first release', first_release(model)), ('unversioned', model._schema_v1())]:
+            reset(model)
+            model._db.create_tables(tables)
+            populate_old(model, tables)
+            model.migrate_database()
+            failed |= compare(name, fresh, schema(model))
+            failed |= check_old_data(model)
+            print(f"{name}: migrated")
+        failed |= check_writes(model)
+        print("writes: checked")
+
+        reset(model)
+        model._db.close()
+        os.chdir('/')
+    if failed:
+        sys.exit(1)
+    print("ok")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# Checks that the listing paths run a constant number of queries, no matter how many users and repos exist.
+#
+#   python benchmarks/query_count.py [users] [repos per user]
+#
+# Runs against a throwaway storage in a temporary directory and exits with 1 if a path needs more queries for a
+# bigger fleet. Set BORGCUBE_DATABASE_URL to run against an empty PostgreSQL database instead of SQLite.
+import contextlib
+import io
+import os
+import sys
+import tempfile
+
+CONFIG = """
+borgcube_executable: '/usr/local/bin/borgcube'
+authorized_keys_file: './authorized_keys'
+storage_path: './storage'
+username: 'borg'
+admin_contact: 'borg <borg@example.net>'
+notification_mail: 'borgcube@example.net'
+"""
+
+KEY = 'ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIJ4ezW3dGLrQ0LNvLhtm+KvBdL4Q8JL0x2VpScChtzDL benchmark'
+
+
+def populate(model, first_user, count, repos_per_user):
+    for i in range(first_user, first_user + count):
+        user = model.User.new(name=f'user{i}', email=f'user{i}@example.net', ssh_key_str=KEY)
+        for j in range(repos_per_user):
+            repo = model.Repository.new(user, f'user{i}_repo{j}', 1)
+            model.RepoLog.log(repo, model.LogOperation.SERVE_MODIFY_SUCCESS, 'benchmark')
+
+
+def measure():
+    from playhouse.test_utils import count_queries
+    from borgcube.backend import model
+    from borgcube.backend.authorized_keys import AuthorizedKeysFile
+    from borgcube.backend.notification import NotificationDispatcher
+    from borgcube.frontend.admin_command import AdminCommand
+
+    class NullNotification(object):
+        def __init__(self, user):
+            pass
+
+        def dispatch_too_old_backups_notification(self, repos, logs):
+            pass
+
+    def user_list():
+        for user in model.FleetView().users:
+            AdminCommand._print_user_line(user, 0)
+
+    paths = {
+        'authorized_keys': lambda: AuthorizedKeysFile(model.FleetView().users).get_authorized_keys_str(),
+        'user list': user_list,
+        'repo logs': model.RepoLog.format_all_logs,
+        'user logs': model.UserLog.format_all_logs,
+        'consistency check': model.check_consistency,
+        'notifications': NotificationDispatcher([NullNotification]).dispatch_too_old_backups_notifications,
+        'log cleanup': model.RepoLog.cleanup_logs,
+    }
+    counts = {}
+    for name, func in paths.items():
+        with count_queries() as counter, contextlib.redirect_stdout(io.StringIO()):
+            func()
+        counts[name] = counter.count
+    return model, counts
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    repos_per_user = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        with open('config.yaml', 'w') as f:
+            f.write(CONFIG)
+            if os.environ.get('BORGCUBE_DATABASE_URL'):
+                f.write(f"database_url: '{os.environ['BORGCUBE_DATABASE_URL']}'\n")
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        from borgcube.backend import model
+
+        populate(model, 0, users, repos_per_user)
+        model, small = measure()
+        populate(model, users, users, repos_per_user)
+        model, large = measure()
+
+    failed = False
+    print(f"{'PATH':<21}{users} USERS   {users * 2} USERS")
+    for name in small:
+        print(f"{name:<21}{small[name]:<10}{large[name]}")
+        if large[name] > small[name]:
+            failed = True
+    if failed:
+        print("Query count grows with the number of users")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# Compares the fleet-wide read paths built on model instances (Fleet, RepoLog.select_with_repo) with the tuple read
+# models (FleetView, RepoLog.select_rows).
+#
+#   python benchmarks/read_models.py [users] [repos per user] [logs per repo]
+#
+# Fills a throwaway database in a temporary directory and prints time, retained memory (what the result keeps alive)
+# and peak allocated memory of every path. Exits with 1 if both sides don't produce the same authorized_keys file and
+# log lines.
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+CONFIG = """
+borgcube_executable: '/usr/local/bin/borgcube'
+authorized_keys_file: './authorized_keys'
+storage_path: './storage'
+username: 'borg'
+admin_contact: 'borg <borg@example.net>'
+notification_mail: 'borgcube@example.net'
+"""
+
+KEY = 'ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIJ4ezW3dGLrQ0LNvLhtm+KvBdL4Q8JL0x2VpScChtzDL benchmark'
+
+
+def populate(model, users, repos_per_user, logs_per_repo):
+    # Inserted directly, the read paths don't look at the storage directories
+    with model._db.atomic():
+        for batch in model.chunked(range(users), 500):
+            model.User.insert_many([{'name': f'user{i}', 'email': f'user{i}@example.net', '_ssh_key': KEY}
+                                    for i in batch]).execute()
+        user_ids = [user_id for user_id, in model.User.select(model.User.id).tuples()]
+        repos = [{'user': user_id, 'name': f'repo{user_id}_{j}', '_append_ssh_key': KEY}
+                 for user_id in user_ids for j in range(repos_per_user)]
+        for batch in model.chunked(repos, 500):
+            model.Repository.insert_many(batch).execute()
+        repo_ids = [repo_id for repo_id, in model.Repository.select(model.Repository.id).tuples()]
+        logs = [{'repo': repo_id, 'operation': model.LogOperation.SERVE_MODIFY_SUCCESS, 'data': f'Transaction {k}'}
+                for repo_id in repo_ids for k in range(logs_per_repo)]
+        for batch in model.chunked(logs, 500):
+            model.RepoLog.insert_many(batch).execute()
+
+
+def authorized_keys_str(users):
+    # The pre-read-model generator, the keys are parsed SSHKey objects
+    from borgcube.backend.authorized_keys import AuthorizedKeysFile, AuthorizedKeyType
+    keys_file = AuthorizedKeysFile(users)
+    s = '# THIS FILE IS AUTOGENERATED BY BORGCUBE. DO NOT EDIT!\n'
+    for user in users:
+        s += f'\n### USER: {user.name}\n'
+        if user.ssh_key:
+            s += f'# USER KEY\n'
+            s += f'{keys_file.get_key_options(user, AuthorizedKeyType.USER)} '
+            s += f'{user.ssh_key.keydata}\n'
+        if user.backup_ssh_key:
+            s += f'# USER BACKUP KEY\n'
+            s += f'{keys_file.get_key_options(user, AuthorizedKeyType.USER_BACKUP)} '
+            s += f'{user.backup_ssh_key.keydata}\n'
+        s += '\n'
+        for repo in user.repos:
+            s += f'## REPO: {repo.name}\n'
+            if repo.append_ssh_key:
+                s += f'# Append key\n'
+                s += f'{keys_file.get_key_options(user, AuthorizedKeyType.REPO_APPEND, repo=repo)} '
+                s += f'{repo.append_ssh_key.keydata}\n'
+            if repo.rw_ssh_key:
+                s += f'# R/W key\n'
+                s += f'{keys_file.get_key_options(user, AuthorizedKeyType.REPO_RW, repo=repo)} '
+                s += f'{repo.rw_ssh_key.keydata}\n'
+        s += '\n'
+    return s
+
+
+def measure(func):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    result = func()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, retained, peak
+
+
+def paths(model):
+    from borgcube.backend.authorized_keys import AuthorizedKeysFile
+    return [
+        ('fleet', lambda: model.Fleet().users, lambda: model.FleetView().users),
+        ('authorized_keys', lambda: authorized_keys_str(model.Fleet().users),
+         lambda: AuthorizedKeysFile(model.FleetView().users).get_authorized_keys_str()),
+        ('repo logs', lambda: [log.format_line() for log in model.RepoLog.select_with_repo()],
+         model.RepoLog.format_all_logs),
+    ]
+
+
+def mb(value):
+    return f'{value / 1000 / 1000:.1f} MB'
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    repos_per_user = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    logs_per_repo = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        with open('config.yaml', 'w') as f:
+            f.write(CONFIG)
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        from borgcube.backend import model
+
+        populate(model, users, repos_per_user, logs_per_repo)
+        print(f"{users} users, {users * repos_per_user} repos, {users * repos_per_user * logs_per_repo} log entries")
+        print(f"{'PATH':<17}{'READ':<8}{'MS':<10}{'RETAINED':<12}{'PEAK':<12}{'SPEEDUP'}")
+        failed = False
+        for name, models, rows in paths(model):
+            model_result, model_elapsed, model_retained, model_peak = measure(models)
+            row_result, row_elapsed, row_retained, row_peak = measure(rows)
+            print(f"{name:<17}{'models':<8}{model_elapsed * 1000:<10.0f}{mb(model_retained):<12}{mb(model_peak)}")
+            print(f"{'':<17}{'rows':<8}{row_elapsed * 1000:<10.0f}{mb(row_retained):<12}{mb(row_peak):<12}"
+                  f"{model_elapsed / row_elapsed:.1f}x")
+            if name != 'fleet' and model_result != row_result:
+                print(f"{name}: models and rows disagree")
+                failed = True
+        os.chdir('/')
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# Starts many concurrent 'borgcube remote' borg serve sessions the way sshd would, without sshd.
+#
+#   python benchmarks/remote_load.py [--concurrency 1,10,50,200] [--sessions 200] [--hold 0.2] [--broker] [--check]
+#
+# Every session gets the environment of an authorized_keys entry (SSH_CONNECTION, BORGCUBE_KEY_TYPE, BORGCUBE_USER,
+# BORGCUBE_REPO, SSH_ORIGINAL_COMMAND). borg is replaced by a stub that records when it was started and then sleeps
+# for --hold seconds. Dispatch latency is the time from spawning borgcube until the stub runs.
+#
+# A writer thread ingests the journal while the sessions run, like 'borgcube daemon' does. Its lock wait is the time
+# it takes to get the SQLite write lock.
+#
+# Runs against a throwaway storage in a temporary directory. With --check it exits with 1 if a session failed or hit
+# a database lock error, so it can run in CI.
+import argparse
+import getpass
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIG = """
+borgcube_executable: '{tmp}/borgcube'
+authorized_keys_file: './authorized_keys'
+storage_path: './storage'
+username: '{username}'
+borg_executable: '{tmp}/borg'
+admin_contact: 'borg <borg@example.net>'
+notification_mail: 'borgcube@example.net'
+broker_socket: '{broker_socket}'
+"""
+
+BORGCUBE = """#!{python}
+import sys
+sys.path.insert(0, {root!r})
+from borgcube.main import main
+main()
+"""
+
+# Only looks at SSH_ORIGINAL_COMMAND, borgcube passes nothing else to borg serve
+BORG_STUB = """#!{python} -S
+import os, sys, time
+started = time.time()
+session = os.environ['SSH_ORIGINAL_COMMAND'].split('--load-session=')[1]
+with open(os.path.join({sessions!r}, session), 'w') as f:
+    f.write(repr(started))
+time.sleep({hold})
+"""
+
+KEY = 'ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIJ4ezW3dGLrQ0LNvLhtm+KvBdL4Q8JL0x2VpScChtzDL benchmark'
+
+REPO_APPEND = 3
+
+
+def write_executable(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+    os.chmod(path, 0o755)
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def populate(model, users, repos_per_user):
+    repos = []
+    for i in range(users):
+        user = model.User.new(name=f'user{i}', email=f'user{i}@example.net', ssh_key_str=KEY)
+        for j in range(repos_per_user):
+            repos.append((user.id, model.Repository.new(user, f'user{i}_repo{j}', 1).id))
+    return repos
+
+
+class Writer(threading.Thread):
+    def __init__(self, model, interval):
+        super().__init__(daemon=True)
+        self.model = model
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.waits = []
+        self.errors = 0
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                start = time.perf_counter()
+                with self.model._db.atomic(lock_type='IMMEDIATE'):
+                    self.waits.append(time.perf_counter() - start)
+                self.model.RepoLog.ingest_journal()
+            except self.model.OperationalError:
+                self.errors += 1
+
+    def reset(self):
+        self.waits = []
+        self.errors = 0
+
+
+class LoadGenerator(object):
+    def __init__(self, tmp, repos, hold):
+        self.tmp = tmp
+        self.repos = repos
+        self.hold = hold
+        self.sessions_path = os.path.join(tmp, 'sessions')
+        self.next_session = 0
+        self.lock = threading.Lock()
+
+    def env(self, session, user_id, repo_id):
+        env = {
+            'SSH_CONNECTION': f'192.0.2.{session % 250 + 1} {40000 + session % 20000} 192.0.2.254 22',
+            'BORGCUBE_KEY_TYPE': str(REPO_APPEND),
+            'BORGCUBE_USER': str(user_id),
+            'BORGCUBE_REPO': str(repo_id),
+            'SSH_ORIGINAL_COMMAND': f'borg serve --umask=077 --load-session={session}',
+            'LOGNAME': getpass.getuser(),
+            'USER': getpass.getuser(),
+            'HOME': os.environ.get('HOME', self.tmp),
+            'SHELL': '/bin/sh',
+            'PATH': os.environ.get('PATH', '/usr/bin:/bin'),
+        }
+        if 'PYTHONPATH' in os.environ:
+            env['PYTHONPATH'] = os.environ['PYTHONPATH']
+        return env
+
+    def session(self, _):
+        with self.lock:
+            session = self.next_session
+            self.next_session += 1
+        user_id, repo_id = self.repos[session % len(self.repos)]
+        start = time.time()
+        proc = subprocess.run([os.path.join(self.tmp, 'borgcube'), 'remote', 'BORGCUBE_COMMAND_BORG_SERVE'],
+                              env=self.env(session, user_id, repo_id), cwd=self.tmp, stdin=subprocess.DEVNULL,
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        end = time.time()
+        output = proc.stdout.decode(errors='replace')
+        try:
+            with open(os.path.join(self.sessions_path, str(session))) as f:
+                dispatch = float(f.read()) - start
+        except FileNotFoundError:
+            dispatch = None
+        return {
+            'returncode': proc.returncode,
+            'dispatch': dispatch,
+            'total': end - start,
+            'lock_error': 'database is locked' in output,
+            'in_use': 'already in use' in output,
+            'output': output.strip(),
+        }
+
+    def run(self, concurrency, sessions):
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(self.session, range(sessions)))
+        return results, time.time() - start
+
+
+def summarize(concurrency, results, elapsed, writer):
+    dispatch = [result['dispatch'] for result in results if result['dispatch'] is not None]
+    failed = [result for result in results if result['returncode'] != 0 or result['dispatch'] is None]
+    return {
+        'concurrency': concurrency,
+        'sessions': len(results),
+        'throughput': len(results) / elapsed,
+        'dispatch_p50': percentile(dispatch, 50),
+        'dispatch_p95': percentile(dispatch, 95),
+        'dispatch_p99': percentile(dispatch, 99),
+        'dispatch_max': max(dispatch) if dispatch else None,
+        'failed': len(failed),
+        'lock_errors': sum(result['lock_error'] for result in results),
+        'in_use': sum(result['in_use'] for result in results),
+        'writer_lock_wait_p99': percentile(writer.waits, 99) if writer else None,
+        'writer_lock_wait_max': max(writer.waits) if writer and writer.waits else None,
+        'writer_lock_errors': writer.errors if writer else None,
+        'first_failure': failed[0]['output'][-500:] if failed else None,
+    }
+
+
+def ms(value):
+    return '-' if value is None else f'{value * 1000:.0f}'
+
+
+def print_table(summaries):
+    print(f"{'CONC':<6}{'SESS/S':<9}{'P50 MS':<8}{'P95 MS':<8}{'P99 MS':<8}{'MAX MS':<8}{'FAILED':<8}"
+          f"{'LOCKERR':<9}{'WRITER P99/MAX MS'}")
+    for s in summaries:
+        print(f"{s['concurrency']:<6}{s['throughput']:<9.1f}{ms(s['dispatch_p50']):<8}{ms(s['dispatch_p95']):<8}"
+              f"{ms(s['dispatch_p99']):<8}{ms(s['dispatch_max']):<8}{s['failed']:<8}{s['lock_errors']:<9}"
+              f"{ms(s['writer_lock_wait_p99'])}/{ms(s['writer_lock_wait_max'])}")
+    for s in summaries:
+        if s['first_failure']:
+            print(f"\nFirst failure at concurrency {s['concurrency']}:\n{s['first_failure']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent borg serve session load generator')
+    parser.add_argument('--concurrency', default='1,10,50', help='comma separated concurrency levels')
+    parser.add_argument('--sessions', type=int, default=100, help='sessions per concurrency level')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--repos', type=int, default=2, help='repos per user')
+    parser.add_argument('--hold', type=float, default=0.2, help='seconds the borg stub stays connected')
+    parser.add_argument('--writer-interval', type=float, default=0.5,
+                        help='seconds between journal ingests, 0 to disable')
+    parser.add_argument('--broker', action='store_true', help='answer the sessions with borgcube broker')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    parser.add_argument('--check', action='store_true', help='exit with 1 on failed sessions or lock errors')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        broker_socket = os.path.join(tmp, 'broker.sock') if args.broker else ''
+        with open('config.yaml', 'w') as f:
+            f.write(CONFIG.format(tmp=tmp, username=getpass.getuser(), broker_socket=broker_socket))
+        os.mkdir('sessions')
+        write_executable(os.path.join(tmp, 'borgcube'), BORGCUBE.format(python=sys.executable, root=ROOT))
+        write_executable(os.path.join(tmp, 'borg'), BORG_STUB.format(python=sys.executable, hold=args.hold,
+                                                                       sessions=os.path.join(tmp, 'sessions')))
+        sys.path.insert(0, ROOT)
+        from borgcube.backend import model
+
+        repos = populate(model, args.users, args.repos)
+        model._db.close()
+
+        broker = None
+        if args.broker:
+            env = {key: value for key, value in os.environ.items()
+                   if key not in ('SSH_CONNECTION', 'BORGCUBE_KEY_TYPE')}
+            broker = subprocess.Popen([os.path.join(tmp, 'borgcube'), 'broker'], env=env, stdout=subprocess.DEVNULL)
+            while not os.path.exists(broker_socket) and broker.poll() is None:
+                time.sleep(0.05)
+
+        writer = Writer(model, args.writer_interval) if args.writer_interval > 0 else None
+        if writer:
+            writer.start()
+        generator = LoadGenerator(tmp, repos, args.hold)
+        summaries = []
+        try:
+            for concurrency in [int(level) for level in args.concurrency.split(',')]:
+                if writer:
+                    writer.reset()
+                results, elapsed = generator.run(concurrency, args.sessions)
+                summaries.append(summarize(concurrency, results, elapsed, writer))
+        finally:
+            if writer:
+                writer.stopped.set()
+                writer.join()
+            if broker:
+                broker.terminate()
+                broker.wait()
+            os.chdir('/')
+
+    if args.json:
+        print(json.dumps(summaries, indent=2))
+    else:
+        print_table(summaries)
+    if args.check and any(s['failed'] or s['lock_errors'] or s['writer_lock_errors'] for s in summaries):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,13 @@
+import os
+
 from atomicwrites import atomic_write
+from borgcube.backend.cluster import cluster as _cluster
 from borgcube.backend.config import cfg as _cfg
 from borgcube.enum import AuthorizedKeyType, RemoteCommandType
 
 
 class AuthorizedKeysFile(object):
+    # users are the UserRows of a FleetView, their keys are key strings
     def __init__(self, users):
         self.users = users
         self.command_prefix = f"{_cfg['borgcube_executable']} remote"
@@ -25,32 +29,51 @@ class AuthorizedKeysFile(object):
             ]
         return ','.join(options)
 
-    def get_authorized_keys_str(self):
+    def get_authorized_keys_str(self, users=None):
+        if users is None:
+            users = self.users
         s = '# THIS FILE IS AUTOGENERATED BY BORGCUBE. DO NOT EDIT!\n'
-        for user in self.users:
+        for user in users:
             s += f'\n### USER: {user.name}\n'
             if user.ssh_key:
                 s += f'# USER KEY\n'
                 s += f'{self.get_key_options(user, AuthorizedKeyType.USER)} '
-                s += f'{user.ssh_key.keydata}\n'
+                s += f'{user.ssh_key}\n'
             if user.backup_ssh_key:
                 s += f'# USER BACKUP KEY\n'
                 s += f'{self.get_key_options(user, AuthorizedKeyType.USER_BACKUP)} '
-                s += f'{user.backup_ssh_key.keydata}\n'
+                s += f'{user.backup_ssh_key}\n'
             s += '\n'
             for repo in user.repos:
                 s += f'## REPO: {repo.name}\n'
                 if repo.append_ssh_key:
                     s += f'# Append key\n'
                     s += f'{self.get_key_options(user, AuthorizedKeyType.REPO_APPEND, repo=repo)} '
-                    s += f'{repo.append_ssh_key.keydata}\n'
+                    s += f'{repo.append_ssh_key}\n'
                 if repo.rw_ssh_key:
                     s += f'# R/W key\n'
                     s += f'{self.get_key_options(user, AuthorizedKeyType.REPO_RW, repo=repo)} '
-                    s += f'{repo.rw_ssh_key.keydata}\n'
+                    s += f'{repo.rw_ssh_key}\n'
             s += '\n'
-            return s
+        return s
+
+    def get_files(self) -> dict:
+        # Maps key file paths to their users. In a cluster every node only accepts the keys of its own users. Key files
+        # of other nodes are written if they are reachable from here, each node writes its own on 'borgcube regen'.
+        if not _cluster.enabled:
+            return {_cfg['authorized_keys_file']: self.users}
+        files = {}
+        for node in _cluster.nodes.values():
+            if node.name == _cluster.local_name:
+                path = _cfg['authorized_keys_file']
+            else:
+                path = node.authorized_keys_file
+                if not path or not os.path.isdir(os.path.dirname(os.path.abspath(path))):
+                    continue
+            files[path] = [user for user in self.users if _cluster.node_name(user.node) == node.name]
+        return files
 
     def save_atomic(self):
-        with atomic_write(_cfg['authorized_keys_file'], overwrite=True) as f:
-            f.write(self.get_authorized_keys_str())
+        for path, users in self.get_files().items():
+            with atomic_write(path, overwrite=True) as f:
+                f.write(self.get_authorized_keys_str(users))
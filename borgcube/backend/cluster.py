@@ -0,0 +1,104 @@
+import os
+from typing import Dict, List, Optional, Tuple
+
+from borgcube.backend.config import cfg as _cfg
+from borgcube.backend.storage import Storage
+from borgcube.exception import ClusterError
+
+
+class Node(object):
+    def __init__(self, name: str, host: str, storage_path: str = None, authorized_keys_file: str = None):
+        self.name = name
+        self.host = host
+        self.storage_path = storage_path
+        self.authorized_keys_file = authorized_keys_file
+        self._storage = None
+
+    @property
+    def reachable(self) -> bool:
+        # The storage of another node can only be used if it is mounted here, e.g. with several nodes on one machine
+        return bool(self.storage_path) and os.path.isdir(self.storage_path)
+
+    @property
+    def storage(self) -> Storage:
+        if not self.reachable:
+            raise ClusterError(f"Storage of node '{self.name}' is not reachable from this host")
+        if self._storage is None:
+            self._storage = Storage(self.storage_path)
+        return self._storage
+
+
+class Cluster(object):
+    # Every user is stored on one node. Each node runs borgcube with its own config and storage, all nodes share the
+    # database (database_url). Without cluster_nodes there is a single node and User.node isn't used.
+
+    def __init__(self, nodes: Dict[str, dict], local_name: str):
+        try:
+            self.nodes = {name: Node(name, **options) for name, options in nodes.items()}
+        except TypeError as e:
+            raise ClusterError(f"Invalid cluster_nodes: {e}")
+        if self.nodes and local_name not in self.nodes:
+            raise ClusterError(f"node_name '{local_name}' is not one of cluster_nodes")
+        self.local_name = local_name if self.nodes else None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.nodes)
+
+    @property
+    def default_name(self) -> Optional[str]:
+        # Users without a node, e.g. from before the cluster was set up, are on the first node
+        return next(iter(self.nodes), None)
+
+    def node_name(self, name: Optional[str]) -> Optional[str]:
+        return name or self.default_name
+
+    def is_local(self, name: Optional[str]) -> bool:
+        return not self.enabled or self.node_name(name) == self.local_name
+
+    def get(self, name: Optional[str]) -> Node:
+        try:
+            return self.nodes[self.node_name(name)]
+        except KeyError:
+            raise ClusterError(f"Node '{name}' is not configured")
+
+    @property
+    def usable_names(self) -> List[str]:
+        # This node and the nodes whose storage is reachable from here
+        return [name for name in self.nodes if name == self.local_name or self.nodes[name].reachable]
+
+    def choose_node(self, allocation: Dict[Optional[str], tuple]) -> str:
+        # allocation maps node names to (user count, allocated user quota). Picks the usable node with the least quota.
+        return min(self.usable_names, key=lambda name: tuple(reversed(allocation.get(name, (0, 0)))))
+
+    def plan_rebalance(self, users: list) -> List[Tuple[object, str, str]]:
+        # Moves users from the node with the most allocated quota to the one with the least, as long as a move
+        # narrows the gap. Only usable nodes take part. Returns (user, from node, to node).
+        allocated = {name: 0 for name in self.usable_names}
+        users_by_node = {name: [] for name in allocated}
+        for user in users:
+            name = self.node_name(user.node)
+            if name not in allocated:
+                continue
+            allocated[name] += user.quota
+            users_by_node[name].append(user)
+        moves = []
+        moved = set()
+        while True:
+            src = max(allocated, key=allocated.get)
+            dst = min(allocated, key=allocated.get)
+            gap = allocated[src] - allocated[dst]
+            candidates = [user for user in users_by_node[src] if user.id not in moved and 0 < user.quota < gap]
+            if not candidates:
+                return moves
+            # The best move halves the gap
+            user = min(candidates, key=lambda candidate: abs(gap / 2 - candidate.quota))
+            users_by_node[src].remove(user)
+            users_by_node[dst].append(user)
+            allocated[src] -= user.quota
+            allocated[dst] += user.quota
+            moved.add(user.id)
+            moves.append((user, src, dst))
+
+
+cluster = Cluster(_cfg['cluster_nodes'], _cfg['node_name'])
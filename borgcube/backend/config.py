@@ -1,18 +1,161 @@
-import yaml
+import hashlib
+import json
 import os
+import stat as stat_module
 
-from borgcube.exception import ConfigFileDoesNotExistError
+from atomicwrites import atomic_write
+
+from borgcube.exception import ConfigFileDoesNotExistError, ConfigError
 
 CONFIG_PATH = ['config.yaml', '/etc/borgcube/config.yaml']
 
-config_filename = None
-for path in CONFIG_PATH:
-    if os.path.isfile(path):
-        config_filename = path
-        break
-
-if config_filename:
-    with open(config_filename, 'r') as yamlfile:
-        cfg = yaml.safe_load(yamlfile)
-else:
-    raise ConfigFileDoesNotExistError()
+REQUIRED = object()
+
+# Configuration keys with their type and default value. Keys with a default of REQUIRED have to be set in the config
+# file. Unknown keys are passed through unchanged.
+CONFIG_SCHEMA = {
+    'borgcube_executable': (str, REQUIRED),
+    'authorized_keys_file': (str, REQUIRED),
+    'storage_path': (str, REQUIRED),
+    'default_repo_quota': (int, 100000000000),
+    'default_user_quota': (int, 500000000000),
+    'username': (str, REQUIRED),
+    'borg_executable': (str, 'borg'),
+    'admin_contact': (str, REQUIRED),
+    'server_name': (str, 'borgcube'),
+    'notification_mail': (str, REQUIRED),
+    'notification_backup_age_days_default': (int, 2),
+    'notification_escalation_days': (list, [1, 3, 7]),
+    'quota_warning_thresholds': (list, [80, 90, 95]),
+    'storage_volumes': (list, []),
+    'storage_placement': (str, 'free_space'),
+    'database_url': (str, ''),
+    'node_name': (str, ''),
+    'cluster_nodes': (dict, {}),
+    'mirror_path': (str, ''),
+    'mirror_workers': (int, 8),
+    'trash_grace_days': (int, 0),
+    'trash_workers': (int, 4),
+    'trash_purge_rate': (int, 0),
+    'schedule_window': (str, '22:00-06:00'),
+    'schedule_default_duration': (int, 1800),
+    'usage_sample_interval': (int, 900),
+    'daemon_workers': (int, 4),
+    'daemon_jitter': (float, 0.1),
+    'daemon_ingest_interval': (int, 60),
+    'daemon_notification_interval': (int, 86400),
+    'daemon_cleanup_interval': (int, 86400),
+    'daemon_usage_interval': (int, 3600),
+    'daemon_consistency_interval': (int, 3600),
+    'broker_socket': (str, ''),
+    'broker_timeout': (float, 5.0),
+    'event_webhooks': (list, []),
+    'event_command': (str, ''),
+    'event_timeout': (float, 10.0),
+    'event_batch_size': (int, 100),
+    'event_max_attempts': (int, 10),
+    'event_retry_backoff': (int, 60),
+    'daemon_event_interval': (int, 30),
+    'daemon_quota_warning_interval': (int, 300),
+    'daemon_mirror_interval': (int, 60),
+    'daemon_trash_interval': (int, 3600),
+    'daemon_quota_interval': (int, 60),
+    'daemon_schedule_interval': (int, 86400),
+}
+
+
+def _schema_fingerprint():
+    schema = sorted((key, value_type.__name__, 'REQUIRED' if default is REQUIRED else repr(default))
+                    for key, (value_type, default) in CONFIG_SCHEMA.items())
+    return hashlib.sha1(repr(schema).encode()).hexdigest()
+
+
+def _cache_filename(filename):
+    directory, name = os.path.split(os.path.abspath(filename))
+    return os.path.join(directory, f'.{name}.cache')
+
+
+def _find_config_file():
+    for path in CONFIG_PATH:
+        if os.path.isfile(path):
+            return path
+    raise ConfigFileDoesNotExistError(f"No config file found. Searched: {', '.join(CONFIG_PATH)}")
+
+
+def validate(config) -> dict:
+    if not isinstance(config, dict):
+        raise ConfigError("The config file must contain a mapping of keys to values")
+    validated = dict(config)
+    for key, (value_type, default) in CONFIG_SCHEMA.items():
+        value = config.get(key)
+        if value is None:
+            if default is REQUIRED:
+                raise ConfigError(f"Missing config value: '{key}'")
+            validated[key] = default
+            continue
+        if value_type in (list, dict) and not isinstance(value, value_type):
+            raise ConfigError(f"Invalid config value for '{key}': expected {value_type.__name__}, got '{value}'")
+        try:
+            validated[key] = value_type(value)
+        except (TypeError, ValueError):
+            raise ConfigError(f"Invalid config value for '{key}': expected {value_type.__name__}, got '{value}'")
+    escalation_days = validated['notification_escalation_days']
+    if not escalation_days or not all(isinstance(days, (int, float)) and days > 0 for days in escalation_days):
+        raise ConfigError(f"Invalid config value for 'notification_escalation_days': expected a non-empty list of "
+                          f"positive numbers, got '{escalation_days}'")
+    return validated
+
+
+def _parse(filename) -> dict:
+    import yaml
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    with open(filename, 'r') as yamlfile:
+        try:
+            return validate(yaml.load(yamlfile, Loader=loader))
+        except yaml.YAMLError as e:
+            raise ConfigError(f"Can't parse config file '{filename}': {e}")
+
+
+def load(filename=None) -> dict:
+    # The validated config is cached next to the config file, keyed by path, mtime, size and schema. Most
+    # invocations (every ssh connection) only read the cache and never import yaml.
+    if filename is None:
+        filename = _find_config_file()
+    stat = os.stat(filename)
+    # Mode and owner are part of the key, so a chmod of the config file rewrites the cache with the new permissions
+    key = [os.path.abspath(filename), stat.st_mtime_ns, stat.st_size, stat.st_mode, stat.st_uid, stat.st_gid,
+           _schema_fingerprint()]
+    cache_filename = _cache_filename(filename)
+    try:
+        with open(cache_filename, 'r') as f:
+            cache = json.load(f)
+        if cache['key'] == key:
+            return cache['config']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    config = _parse(filename)
+    try:
+        with atomic_write(cache_filename, overwrite=True) as f:
+            json.dump({'key': key, 'config': config}, f)
+            # The cache is written by root from cron and read by the borgcube user. It can contain the database
+            # password, so it gets the owner and permissions of the config file.
+            os.fchmod(f.fileno(), stat_module.S_IMODE(stat.st_mode))
+            try:
+                os.fchown(f.fileno(), stat.st_uid, stat.st_gid)
+            except PermissionError:
+                pass
+    except (OSError, TypeError, ValueError):
+        # No write access to the config directory or values that can't be cached. Parse again next time.
+        pass
+    return config
+
+
+def reload():
+    # Updates cfg in place, so all modules that imported it see the new values
+    new_cfg = load()
+    cfg.clear()
+    cfg.update(new_cfg)
+
+
+cfg = load()
@@ -0,0 +1,179 @@
+import asyncio
+import datetime
+import random
+import signal
+import time
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+from borgcube.backend import config
+from borgcube.backend.config import cfg as _cfg
+from borgcube.backend.model import User, Repository, RepoLog, UsageSample, MirrorState, TrashEntry, \
+    check_consistency, dispatch_events
+from borgcube.backend.notification import NotificationDispatcher
+from borgcube.exception import BorgcubeError
+
+
+# Objects built from these keys when borgcube starts, SIGHUP doesn't change them
+RESTART_KEYS = ['storage_path', 'storage_volumes', 'storage_placement', 'mirror_path', 'database_url', 'cluster_nodes',
+                'node_name', 'daemon_workers']
+
+
+def _log(msg):
+    print(f"[{datetime.datetime.now().isoformat()}] {msg}", flush=True)
+
+
+class Job(object):
+    def __init__(self, name: str, func: Callable, interval_key: str):
+        self.name = name
+        self.func = func
+        self.interval_key = interval_key
+        self.next_run = None
+        self.running = False
+
+    @property
+    def interval(self) -> float:
+        return _cfg[self.interval_key]
+
+
+def cleanup():
+    RepoLog.cleanup_logs()
+    UsageSample.compact()
+
+
+def default_jobs() -> List[Job]:
+    return [
+        Job('ingest journal', RepoLog.ingest_journal, 'daemon_ingest_interval'),
+        Job('notifications', NotificationDispatcher().cron, 'daemon_notification_interval'),
+        Job('cleanup', cleanup, 'daemon_cleanup_interval'),
+        Job('usage sampling', UsageSample.sample_local, 'daemon_usage_interval'),
+        Job('consistency check', check_consistency, 'daemon_consistency_interval'),
+        Job('events', dispatch_events, 'daemon_event_interval'),
+        Job('quota warnings', NotificationDispatcher().dispatch_quota_warnings, 'daemon_quota_warning_interval'),
+        Job('mirror', MirrorState.mirror_pending, 'daemon_mirror_interval'),
+        Job('trash', TrashEntry.purge_expired, 'daemon_trash_interval'),
+        Job('pending quotas', Repository.apply_pending_quotas, 'daemon_quota_interval'),
+        Job('backup slots', Repository.plan_backup_slots, 'daemon_schedule_interval'),
+    ]
+
+
+class SynchronousExecutor(Executor):
+    # Runs every job in the calling thread. With a fake clock the scheduler then runs the same way every time.
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+
+class Scheduler(object):
+    # Runs every job in a thread pool on its own interval. Clock, sleep and random source can be replaced to run the
+    # scheduler in the foreground with a fake clock, together with a SynchronousExecutor.
+
+    def __init__(self, jobs: List[Job], clock: Callable[[], float] = time.monotonic, sleep=asyncio.sleep,
+                 rand: Callable[[], float] = random.random, executor=None):
+        self.jobs = jobs
+        self.clock = clock
+        self.sleep = sleep
+        self.rand = rand
+        self.executor = executor
+        self.tasks = set()
+        self._stop = False
+        self._reload = False
+
+    def _jitter(self, interval) -> float:
+        return interval * _cfg['daemon_jitter'] * (2 * self.rand() - 1)
+
+    def schedule(self, job: Job, now: float, initial=False):
+        if initial:
+            # Spread the first runs over the interval so jobs don't all start at once
+            job.next_run = now + job.interval * _cfg['daemon_jitter'] * self.rand()
+        else:
+            job.next_run = now + job.interval + self._jitter(job.interval)
+
+    def stop(self):
+        self._stop = True
+
+    def request_reload(self):
+        self._reload = True
+
+    def reload(self):
+        self._reload = False
+        old = {key: _cfg[key] for key in RESTART_KEYS}
+        try:
+            config.reload()
+        except BorgcubeError as e:
+            _log(f"Reloading config failed, keeping the old config: {e}")
+            return
+        changed = [key for key in RESTART_KEYS if _cfg[key] != old[key]]
+        if changed:
+            _log(f"Changes to {', '.join(changed)} only take effect after a restart")
+        now = self.clock()
+        for job in self.jobs:
+            self.schedule(job, now)
+        _log("Reloaded config")
+
+    async def _run_job(self, job: Job):
+        loop = asyncio.get_event_loop()
+        begin = self.clock()
+        try:
+            await loop.run_in_executor(self.executor, job.func)
+        except Exception as e:
+            _log(f"Job '{job.name}' failed: {e!r}")
+        else:
+            _log(f"Job '{job.name}' finished in {self.clock() - begin:.1f}s")
+        finally:
+            job.running = False
+            self.schedule(job, self.clock())
+
+    def run_due(self) -> Optional[float]:
+        # Starts all due jobs and returns the time until the next job is due
+        now = self.clock()
+        for job in self.jobs:
+            if not job.running and job.next_run <= now:
+                job.running = True
+                task = asyncio.ensure_future(self._run_job(job))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+        waiting = [job.next_run - now for job in self.jobs if not job.running]
+        return max(0.0, min(waiting)) if waiting else None
+
+    async def run(self, max_iterations: int = None):
+        now = self.clock()
+        for job in self.jobs:
+            self.schedule(job, now, initial=True)
+        iterations = 0
+        while not self._stop and (max_iterations is None or iterations < max_iterations):
+            iterations += 1
+            if self._reload:
+                self.reload()
+            delay = self.run_due()
+            # Wake up at least every second to notice signals and finished jobs
+            await self.sleep(min(delay, 1.0) if delay is not None else 1.0)
+        if self.tasks:
+            _log(f"Waiting for {len(self.tasks)} running jobs")
+            await asyncio.gather(*self.tasks)
+
+
+class Daemon(object):
+    def __init__(self, jobs: List[Job] = None):
+        self.executor = ThreadPoolExecutor(max_workers=_cfg['daemon_workers'])
+        self.scheduler = Scheduler(jobs or default_jobs(), executor=self.executor)
+
+    def run(self) -> int:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.add_signal_handler(signal.SIGHUP, self.scheduler.request_reload)
+        loop.add_signal_handler(signal.SIGTERM, self.scheduler.stop)
+        loop.add_signal_handler(signal.SIGINT, self.scheduler.stop)
+        _log(f"borgcube daemon started with {len(self.scheduler.jobs)} jobs")
+        try:
+            loop.run_until_complete(self.scheduler.run())
+        finally:
+            self.executor.shutdown(wait=True)
+            loop.close()
+        _log("borgcube daemon stopped")
+        return 0
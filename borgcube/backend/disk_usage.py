@@ -0,0 +1,140 @@
+import fcntl
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+from time import time
+from typing import Dict, List
+
+from atomicwrites import atomic_write
+
+# Files modified more recently than this may still be growing (e.g. the active borg segment), so the directory
+# they live in is not cached.
+SETTLE_SECONDS = 600
+
+
+class DiskUsageScanner(object):
+    # Caches the size of the files directly inside each directory together with the directory mtime. Borg segment
+    # directories only change when segments are added or compacted away, so a re-scan of a big repository only
+    # reads the directories with new segments and stat()s the rest. Only those are read by the worker threads.
+
+    def __init__(self, cache_path, workers=8):
+        self.cache_path = Path(cache_path)
+        self.workers = workers
+        self._cache = None
+        # Paths updated or removed since the cache was loaded, other processes may have saved it meanwhile
+        self._changed = set()
+        self._removed = set()
+
+    @property
+    def cache(self) -> Dict[str, list]:
+        if self._cache is None:
+            try:
+                with open(self.cache_path, 'r') as f:
+                    self._cache = json.load(f)
+            except (OSError, ValueError):
+                self._cache = {}
+        return self._cache
+
+    def _cached(self, path: str):
+        # (size, subdirs) of a directory that didn't change since it was cached, otherwise None
+        try:
+            dir_stat = os.stat(path)
+        except OSError:
+            return 0, []
+        cached = self.cache.get(path)
+        if cached and cached[0] == dir_stat.st_mtime_ns:
+            return cached[1], cached[2]
+        return None
+
+    def _scan_dir(self, path: str):
+        try:
+            dir_stat = os.stat(path)
+        except OSError:
+            return 0, []
+
+        size = dir_stat.st_blocks * 512
+        subdirs = []
+        newest = 0
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                        continue
+                    entry_stat = entry.stat(follow_symlinks=False)
+                    size += entry_stat.st_blocks * 512
+                    newest = max(newest, entry_stat.st_mtime)
+        except OSError:
+            return size, subdirs
+        if time() - newest > SETTLE_SECONDS:
+            self.cache[path] = [dir_stat.st_mtime_ns, size, subdirs]
+            self._changed.add(path)
+        elif self.cache.pop(path, None) is not None:
+            self._removed.add(path)
+        return size, subdirs
+
+    def scan(self, roots: List[Path]) -> Dict[Path, int]:
+        totals = {root: 0 for root in roots}
+        visited = set()
+        todo = [(root, str(root)) for root in roots]
+        pending = {}
+        executor = None
+        try:
+            while todo or pending:
+                while todo:
+                    root, path = todo.pop()
+                    result = self._cached(path)
+                    if result is None:
+                        if executor is None:
+                            executor = ThreadPoolExecutor(max_workers=self.workers)
+                        pending[executor.submit(self._scan_dir, path)] = (root, path)
+                        continue
+                    visited.add(path)
+                    totals[root] += result[0]
+                    todo += [(root, os.path.join(path, name)) for name in result[1]]
+                if pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        root, path = pending.pop(future)
+                        visited.add(path)
+                        size, subdirs = future.result()
+                        totals[root] += size
+                        todo += [(root, os.path.join(path, name)) for name in subdirs]
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        self._prune(roots, visited)
+        self.save()
+        return totals
+
+    def _prune(self, roots: List[Path], visited):
+        prefixes = tuple(str(root) + os.sep for root in roots)
+        for path in list(self.cache):
+            if path.startswith(prefixes) and path not in visited:
+                del self.cache[path]
+                self._removed.add(path)
+
+    def save(self):
+        # Writes the changes on top of the cache file as it is now, so concurrent scans don't undo each other
+        if not self._changed and not self._removed:
+            return
+        try:
+            with open(str(self.cache_path) + '.lock', 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    with open(self.cache_path, 'r') as f:
+                        cache = json.load(f)
+                except (OSError, ValueError):
+                    cache = {}
+                for path in self._removed:
+                    cache.pop(path, None)
+                cache.update({path: self.cache[path] for path in self._changed if path in self.cache})
+                with atomic_write(str(self.cache_path), overwrite=True) as f:
+                    json.dump(cache, f)
+            self._cache = cache
+        except OSError:
+            # The cache is only an optimization
+            pass
+        self._changed.clear()
+        self._removed.clear()
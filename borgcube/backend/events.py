@@ -0,0 +1,239 @@
+import fcntl
+import http.client
+import json
+import os
+import shlex
+import subprocess
+import urllib.error
+import urllib.request
+from pathlib import Path
+from time import time, time_ns
+from typing import List, Optional
+
+from atomicwrites import atomic_write
+
+from borgcube.backend.config import cfg as _cfg
+from borgcube.enum import EventType
+
+SUFFIX = '.json'
+
+
+class Event(object):
+    def __init__(self, name: str, record: dict):
+        self.name = name
+        self.record = record
+
+    @property
+    def payload(self) -> dict:
+        return {key: self.record[key] for key in ('id', 'type', 'time', 'server', 'data')}
+
+    @property
+    def attempts(self) -> int:
+        return self.record.get('attempts', 0)
+
+    @property
+    def delivered(self) -> List[str]:
+        return self.record.setdefault('delivered', [])
+
+    def is_due(self, now: float) -> bool:
+        return self.record.get('next_attempt', 0) <= now
+
+
+class Outbox(object):
+    # Spool directory of events for external systems. emit() is called on the borg serve path, it only writes one
+    # small file and never touches the database or the network. Events are delivered by EventDispatcher.
+
+    def __init__(self, path, server_name: str = None, enabled: bool = None):
+        # server_name and enabled follow the config, so a reloaded daemon picks up new event targets
+        self.path = Path(path)
+        self._server_name = server_name
+        self._enabled = enabled
+        self.new_path = self.path.joinpath('new')
+        self.failed_path = self.path.joinpath('failed')
+        self.tmp_path = self.path.joinpath('tmp')
+
+    @property
+    def server_name(self) -> str:
+        return self._server_name or _cfg['server_name']
+
+    @property
+    def enabled(self) -> bool:
+        if self._enabled is not None:
+            return self._enabled
+        return bool(_cfg['event_webhooks'] or _cfg['event_command'])
+
+    def create_if_needed(self):
+        for path in (self.path, self.new_path, self.failed_path, self.tmp_path):
+            path.mkdir(exist_ok=True)
+
+    def emit(self, event_type: EventType, data: dict):
+        if not self.enabled:
+            return
+        now = time_ns()
+        event_id = f'{now:020d}-{os.getpid()}-{os.urandom(4).hex()}'
+        record = {
+            'id': event_id,
+            'type': event_type.value,
+            'time': now / 1e9,
+            'server': self.server_name,
+            'data': data,
+        }
+        tmp = self.tmp_path.joinpath(event_id + SUFFIX)
+        with open(tmp, 'w') as f:
+            json.dump(record, f)
+        # Readers only ever see complete files
+        os.rename(tmp, self.new_path.joinpath(event_id + SUFFIX))
+
+    def _list(self, path: Path) -> List[str]:
+        try:
+            return sorted(name for name in os.listdir(path) if name.endswith(SUFFIX))
+        except FileNotFoundError:
+            return []
+
+    def _load(self, path: Path, name: str) -> Optional[Event]:
+        try:
+            with open(path.joinpath(name), 'r') as f:
+                return Event(name, json.load(f))
+        except (OSError, ValueError):
+            return None
+
+    def pending(self) -> List[Event]:
+        return [event for event in (self._load(self.new_path, name) for name in self._list(self.new_path)) if event]
+
+    def failed(self) -> List[Event]:
+        return [event for event in (self._load(self.failed_path, name) for name in self._list(self.failed_path))
+                if event]
+
+    def update(self, event: Event):
+        with atomic_write(str(self.new_path.joinpath(event.name)), overwrite=True) as f:
+            json.dump(event.record, f)
+
+    def remove(self, event: Event):
+        try:
+            os.unlink(self.new_path.joinpath(event.name))
+        except FileNotFoundError:
+            pass
+
+    def fail(self, event: Event):
+        os.rename(self.new_path.joinpath(event.name), self.failed_path.joinpath(event.name))
+
+    def retry_failed(self) -> int:
+        names = self._list(self.failed_path)
+        for name in names:
+            os.rename(self.failed_path.joinpath(name), self.new_path.joinpath(name))
+        return len(names)
+
+    def lock(self):
+        # Returns an open lock file or None if another dispatcher is running
+        f = open(self.path.joinpath('.lock'), 'w')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return None
+        return f
+
+
+class WebhookTarget(object):
+    def __init__(self, url: str, timeout: float):
+        self.url = url
+        self.timeout = timeout
+        self.name = url
+
+    def deliver(self, payloads: List[dict]):
+        request = urllib.request.Request(self.url, data=json.dumps({'events': payloads}).encode('utf-8'),
+                                         headers={'Content-Type': 'application/json'}, method='POST')
+        # Raises HTTPError for error status codes
+        with urllib.request.urlopen(request, timeout=self.timeout):
+            pass
+
+
+class CommandTarget(object):
+    def __init__(self, command: str, timeout: float):
+        self.command = command
+        self.timeout = timeout
+        self.name = command
+
+    def deliver(self, payloads: List[dict]):
+        # The command gets the batch as JSON on stdin and has to exit with 0
+        subprocess.run(shlex.split(self.command), input=json.dumps({'events': payloads}).encode('utf-8'),
+                       timeout=self.timeout, check=True, stdout=subprocess.DEVNULL)
+
+
+class EventDispatcher(object):
+    def __init__(self, outbox: Outbox, targets: list, batch_size=100, max_attempts=10, backoff=60, max_backoff=86400,
+                 clock=time):
+        self.outbox = outbox
+        self.targets = targets
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.clock = clock
+
+    def _deliver(self, target, events: List[Event]) -> bool:
+        try:
+            target.deliver([event.payload for event in events])
+        except (OSError, urllib.error.URLError, ValueError, http.client.HTTPException, subprocess.SubprocessError) as e:
+            # ValueError for a malformed webhook URL, HTTPException for a broken response
+            for event in events:
+                event.record['last_error'] = f'{target.name}: {e}'
+            return False
+        for event in events:
+            event.delivered.append(target.name)
+        return True
+
+    def dispatch_once(self) -> int:
+        # Delivers one batch of due events to every target. Returns the number of events that are done.
+        now = self.clock()
+        events = [event for event in self.outbox.pending() if event.is_due(now)][:self.batch_size]
+        if not events:
+            return 0
+        for target in self.targets:
+            todo = [event for event in events if target.name not in event.delivered]
+            if todo:
+                self._deliver(target, todo)
+        target_names = {target.name for target in self.targets}
+        done = 0
+        for event in events:
+            if target_names.issubset(event.delivered):
+                self.outbox.remove(event)
+                done += 1
+                continue
+            attempts = event.attempts + 1
+            event.record['attempts'] = attempts
+            if attempts >= self.max_attempts:
+                self.outbox.update(event)
+                self.outbox.fail(event)
+                done += 1
+            else:
+                event.record['next_attempt'] = now + min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+                self.outbox.update(event)
+        return done
+
+    def dispatch(self) -> int:
+        # Delivers until no due events are left
+        lock = self.outbox.lock()
+        if lock is None:
+            return 0
+        try:
+            total = 0
+            while True:
+                done = self.dispatch_once()
+                if not done:
+                    return total
+                total += done
+        finally:
+            lock.close()
+
+
+def default_targets() -> list:
+    targets = [WebhookTarget(url, _cfg['event_timeout']) for url in _cfg['event_webhooks']]
+    if _cfg['event_command']:
+        targets.append(CommandTarget(_cfg['event_command'], _cfg['event_timeout']))
+    return targets
+
+
+def default_dispatcher(outbox: Outbox) -> EventDispatcher:
+    return EventDispatcher(outbox, default_targets(), _cfg['event_batch_size'], _cfg['event_max_attempts'],
+                           _cfg['event_retry_backoff'])
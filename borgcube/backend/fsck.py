@@ -0,0 +1,213 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Dict
+
+import psutil
+
+from borgcube.backend.model import User, Repository, Fleet, _db, _storage
+from borgcube.backend.storage import BorgRepo, Storage
+from borgcube.exception import StorageError
+
+MISSING_USER_DIR = 'missing_user_dir'
+MISSING_REPO_DIR = 'missing_repo_dir'
+MISSING_REPO_LINK = 'missing_repo_link'
+ORPHAN_USER_DIR = 'orphan_user_dir'
+ORPHAN_REPO_DIR = 'orphan_repo_dir'
+STALE_FILE = 'stale_file'
+TOO_MANY_REPOS = 'too_many_repos'
+NO_BORG_REPO = 'no_borg_repo'
+QUOTA_MISMATCH = 'quota_mismatch'
+STALE_LOCK = 'stale_lock'
+
+# Issues --repair fixes. Everything else needs a decision by the admin.
+REPAIRABLE = {MISSING_USER_DIR, MISSING_REPO_LINK, QUOTA_MISMATCH, STALE_LOCK}
+
+
+class Issue(object):
+    def __init__(self, kind: str, message: str, user: User = None, repo: Repository = None, path: Path = None):
+        self.kind = kind
+        self.message = message
+        self.user = user
+        self.repo = repo
+        self.path = path
+        self.repaired = False
+        self.repair_error = None
+
+    @property
+    def repairable(self) -> bool:
+        return self.kind in REPAIRABLE
+
+    def to_dict(self) -> dict:
+        return {
+            'kind': self.kind,
+            'message': self.message,
+            'user': self.user.name if self.user else None,
+            'repo': self.repo.name if self.repo else None,
+            'path': str(self.path) if self.path else None,
+            'repairable': self.repairable,
+            'repaired': self.repaired,
+            'repair_error': self.repair_error,
+        }
+
+
+class Fsck(object):
+    # Collects every inconsistency between database, storage directories and borg repositories instead of stopping
+    # at the first one. Users and repos are loaded once up front, the workers only look at the file system.
+
+    def __init__(self, storage: Storage = _storage, workers=8, batch_size=100):
+        self.storage = storage
+        self.workers = workers
+        self.batch_size = batch_size
+        fleet = Fleet.local()
+        self.users = fleet.users
+        self.repos = fleet.repos
+        self.issues = []
+
+    def _map(self, func, items) -> List[List[Issue]]:
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(func, items))
+
+    def _check_user(self, user: User) -> List[Issue]:
+        issues = []
+        if not user.path.is_dir():
+            issues.append(Issue(MISSING_USER_DIR, f"Storage for user '{user.name}' is missing", user, path=user.path))
+        repo_count = len(user.repos)
+        if repo_count > user.max_repo_count:
+            issues.append(Issue(TOO_MANY_REPOS, f"User '{user.name}' is allowed to have maximum of "
+                                                f"{user.max_repo_count} repos but {repo_count} were found", user))
+        return issues
+
+    def _check_repo(self, repo: Repository) -> List[Issue]:
+        issues = []
+        path = repo.path
+        link = self.storage.repo_path(repo.user.name, repo.name, repo.user.volume)
+        if repo.volume and path != link and not link.is_symlink():
+            issues.append(Issue(MISSING_REPO_LINK, f"Link to moved repository '{repo.name}' is missing",
+                                repo.user, repo, link))
+        if not path.exists():
+            if repo.volume:
+                issues.append(Issue(MISSING_REPO_DIR, f"Moved repository '{repo.name}' is missing",
+                                    repo.user, repo, path))
+            else:
+                # borg init creates the directory
+                issues.append(Issue(NO_BORG_REPO, f"Repository '{repo.name}' has not been initialized yet",
+                                    repo.user, repo, path))
+            return issues
+
+        borg_repo = BorgRepo(path)
+        if not borg_repo.is_repo:
+            issues.append(Issue(NO_BORG_REPO, f"Directory of repository '{repo.name}' is not a borg repository",
+                                repo.user, repo, path))
+            return issues
+        try:
+            borg_quota = borg_repo.quota
+        except StorageError as e:
+            issues.append(Issue(NO_BORG_REPO, f"Can't read borg config of repository '{repo.name}': {e}",
+                                repo.user, repo, path))
+            return issues
+        # Pending quota changes are written to the borg config once the repo isn't in use
+        if borg_quota != repo.quota and not repo.quota_pending:
+            issues.append(Issue(QUOTA_MISMATCH, f"Quota of repository '{repo.name}' is {repo.quota} but "
+                                                f"{borg_quota} in the borg config", repo.user, repo, path))
+        return issues
+
+    def _check_locks(self) -> List[Issue]:
+        issues = []
+        for obj in self.users + self.repos:
+            if obj.locked != 0 and not psutil.pid_exists(obj.locked):
+                user = obj if isinstance(obj, User) else obj.user
+                repo = obj if isinstance(obj, Repository) else None
+                issues.append(Issue(STALE_LOCK, f"'{obj.name}' is locked by pid {obj.locked} which doesn't exist",
+                                    user, repo))
+        return issues
+
+    def _check_volume_dir(self, user_dir: Path) -> List[Issue]:
+        # user_dir is a directory in the backups directory of a volume
+        owner = self._expected_user_dirs.get(user_dir)
+        if owner is None:
+            return [Issue(ORPHAN_USER_DIR, f"Directory '{user_dir}' doesn't belong to any user", path=user_dir)]
+        issues = []
+        for entry in os.scandir(user_dir):
+            path = user_dir.joinpath(entry.name)
+            if entry.name.startswith('.'):
+                # Leftovers of a repository move
+                continue
+            if path in self._expected_repo_paths:
+                continue
+            if entry.is_dir():
+                issues.append(Issue(ORPHAN_REPO_DIR, f"Stale repository '{entry.name}' found in user directory "
+                                                     f"of '{owner.name}'", owner, path=path))
+            else:
+                issues.append(Issue(STALE_FILE, f"Stale file '{entry.name}' found in user directory "
+                                                f"of '{owner.name}'", owner, path=path))
+        return issues
+
+    def _volume_dirs(self) -> List[Path]:
+        dirs = []
+        for volume in self.storage.volumes:
+            backups_path = self.storage.volume_backups_path(volume)
+            if backups_path.is_dir():
+                dirs += [backups_path.joinpath(name) for name in os.listdir(backups_path)]
+        return dirs
+
+    def check(self) -> List[Issue]:
+        self._expected_user_dirs = {user.path: user for user in self.users}
+        self._expected_repo_paths = set()
+        for repo in self.repos:
+            self._expected_repo_paths.add(repo.path)
+            self._expected_repo_paths.add(self.storage.repo_path(repo.user.name, repo.name, repo.user.volume))
+            self._expected_user_dirs.setdefault(repo.path.parent, repo.user)
+
+        issues = []
+        for result in self._map(self._check_user, self.users):
+            issues += result
+        for result in self._map(self._check_repo, self.repos):
+            issues += result
+        for result in self._map(self._check_volume_dir, self._volume_dirs()):
+            issues += result
+        issues += self._check_locks()
+        self.issues = issues
+        return issues
+
+    def _batches(self, issues: List[Issue]):
+        for i in range(0, len(issues), self.batch_size):
+            yield issues[i:i + self.batch_size]
+
+    def _repair_locks(self, issues: List[Issue]):
+        for batch in self._batches(issues):
+            with _db.atomic():
+                for issue in batch:
+                    obj = issue.repo or issue.user
+                    model = type(obj)
+                    # Only clear the lock if nobody took it since the check
+                    model.update(locked=0).where((model.id == obj.id) & (model.locked == obj.locked)).execute()
+                    issue.repaired = True
+
+    def _repair_one(self, issue: Issue):
+        try:
+            if issue.kind == MISSING_USER_DIR:
+                issue.path.mkdir(parents=True, exist_ok=True)
+            elif issue.kind == MISSING_REPO_LINK:
+                self.storage.link_repo(issue.path, issue.repo.path)
+            elif issue.kind == QUOTA_MISMATCH:
+                # The database is authoritative. set_new_quota_safe refuses quotas below the used space.
+                BorgRepo(issue.repo.path).set_new_quota_safe(issue.repo.quota)
+            issue.repaired = True
+        except (StorageError, OSError) as e:
+            issue.repair_error = str(e)
+
+    def repair(self) -> List[Issue]:
+        repairable = [issue for issue in self.issues if issue.repairable]
+        self._repair_locks([issue for issue in repairable if issue.kind == STALE_LOCK])
+        others = [issue for issue in repairable if issue.kind != STALE_LOCK]
+        for batch in self._batches(others):
+            self._map(self._repair_one, batch)
+        return [issue for issue in repairable if issue.repaired]
+
+    def report(self) -> Dict:
+        return {
+            'users': len(self.users),
+            'repos': len(self.repos),
+            'issues': [issue.to_dict() for issue in self.issues],
+        }
@@ -0,0 +1,179 @@
+import csv
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
+from borgcube.backend.config import cfg as _cfg
+from borgcube.backend.model import User, Repository, SSHKeyField, _name_regex
+from borgcube.exception import DatabaseError, ImportFileError
+
+CSV_COLUMNS = ['user', 'email', 'quota', 'key', 'repo', 'repo_quota', 'append_key', 'rw_key']
+
+
+def _validate_ssh_key(key_string: str) -> Optional[str]:
+    # Runs in a worker process. Only return plain strings, parsed keys are not picklable.
+    try:
+        SSHKeyField.parse_ssh_key(key_string)
+    except (DatabaseError, ValueError) as e:
+        return str(e)
+    return None
+
+
+def _to_gb(value, default_bytes) -> int:
+    if value is None or value == '':
+        return math.floor(int(default_bytes) / 1000 / 1000 / 1000)
+    return int(value)
+
+
+class ImportRepo(object):
+    def __init__(self, name, quota_gb=None, append_key=None, rw_key=None):
+        self.name = str(name)
+        self.quota_gb = _to_gb(quota_gb, _cfg['default_repo_quota'])
+        self.append_key = append_key or None
+        self.rw_key = rw_key or None
+
+
+class ImportUser(object):
+    def __init__(self, name, email, quota_gb=None, key=None, repos=None):
+        self.name = str(name)
+        self.email = str(email)
+        self.quota_gb = _to_gb(quota_gb, _cfg['default_user_quota'])
+        self.key = key or None
+        self.repos = repos or []
+
+    def to_entry(self):
+        return {
+            'name': self.name,
+            'email': self.email,
+            'quota': self.quota_gb * 1000 * 1000 * 1000,
+            '_ssh_key': self.key,
+            'repos': [{
+                'name': repo.name,
+                '_quota_gb': repo.quota_gb,
+                '_append_ssh_key': repo.append_key,
+                '_rw_ssh_key': repo.rw_key,
+            } for repo in self.repos],
+        }
+
+
+class BulkImport(object):
+    def __init__(self, users: List[ImportUser]):
+        self.users = users
+        self.conflicts = []
+
+    @classmethod
+    def from_file(cls, filename, file_format=None) -> 'BulkImport':
+        import yaml
+        if file_format is None:
+            file_format = 'csv' if filename.lower().endswith('.csv') else 'yaml'
+        try:
+            with open(filename, 'r', newline='') as f:
+                if file_format == 'csv':
+                    return cls(cls._parse_csv(f))
+                return cls(cls._parse_yaml(f))
+        except OSError as e:
+            raise ImportFileError(f"Can't read import file: {e}")
+        except (yaml.YAMLError, csv.Error, KeyError, TypeError, ValueError) as e:
+            raise ImportFileError(f"Malformed import file '{filename}': {e}")
+
+    @staticmethod
+    def _parse_yaml(f) -> List[ImportUser]:
+        import yaml
+        data = yaml.safe_load(f)
+        if isinstance(data, dict):
+            data = data.get('users', [])
+        users = []
+        for entry in data or []:
+            repos = [ImportRepo(repo['name'], repo.get('quota'), repo.get('append_key'), repo.get('rw_key'))
+                     for repo in entry.get('repos') or []]
+            users.append(ImportUser(entry['name'], entry['email'], entry.get('quota'), entry.get('key'), repos))
+        return users
+
+    @staticmethod
+    def _parse_csv(f) -> List[ImportUser]:
+        users = {}
+        for row in csv.DictReader(f):
+            row = {column: (row.get(column) or '').strip() for column in CSV_COLUMNS}
+            user = users.get(row['user'])
+            if user is None:
+                user = users[row['user']] = ImportUser(row['user'], row['email'], row['quota'], row['key'])
+            if row['repo']:
+                user.repos.append(ImportRepo(row['repo'], row['repo_quota'], row['append_key'], row['rw_key']))
+        return list(users.values())
+
+    @property
+    def repo_count(self):
+        return sum(len(user.repos) for user in self.users)
+
+    def _conflict(self, msg):
+        self.conflicts.append(msg)
+
+    def _check_names(self):
+        user_names = set()
+        emails = set()
+        repo_names = set()
+        for user in self.users:
+            if len(user.name) > 20 or not _name_regex.match(user.name):
+                self._conflict(f"Invalid user name '{user.name}'")
+            if user.name in user_names:
+                self._conflict(f"User '{user.name}' is listed more than once")
+            user_names.add(user.name)
+            if '@' not in user.email:
+                self._conflict(f"Not a valid email address for user '{user.name}': {user.email}")
+            if user.email in emails:
+                self._conflict(f"Email '{user.email}' is used more than once")
+            emails.add(user.email)
+            if user.key is None:
+                self._conflict(f"User '{user.name}' has no ssh key")
+            if len(user.repos) > User.max_repo_count.default:
+                self._conflict(f"User '{user.name}' has {len(user.repos)} repos but the maximum is "
+                               f"{User.max_repo_count.default}")
+            if sum(repo.quota_gb for repo in user.repos) > user.quota_gb:
+                self._conflict(f"Repos of user '{user.name}' don't fit the user quota of {user.quota_gb} GB")
+            for repo in user.repos:
+                if len(repo.name) > 20 or not _name_regex.match(repo.name):
+                    self._conflict(f"Invalid repository name '{repo.name}' for user '{user.name}'")
+                if repo.quota_gb < 1:
+                    self._conflict(f"Quota of repository '{repo.name}' must be 1 GB or more")
+                if repo.name in repo_names:
+                    self._conflict(f"Repository '{repo.name}' is listed more than once")
+                repo_names.add(repo.name)
+
+        for user in User.select(User.name, User.email).where(User.name.in_(user_names) | User.email.in_(emails)):
+            if user.name in user_names:
+                self._conflict(f"User already exists: '{user.name}'")
+            if user.email in emails:
+                self._conflict(f"Email already in use: '{user.email}'")
+        for repo in Repository.select(Repository.name).where(Repository.name.in_(repo_names)):
+            self._conflict(f"Repository already exists: '{repo.name}'")
+
+    def _check_keys(self, workers=None):
+        keys = []
+        for user in self.users:
+            if user.key:
+                keys.append((f"user '{user.name}'", user.key))
+            for repo in user.repos:
+                if repo.append_key:
+                    keys.append((f"append key of repository '{repo.name}'", repo.append_key))
+                if repo.rw_key:
+                    keys.append((f"read/write key of repository '{repo.name}'", repo.rw_key))
+        if not keys:
+            return
+        workers = workers or os.cpu_count() or 1
+        chunksize = max(1, len(keys) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as executor:
+            errors = executor.map(_validate_ssh_key, [key for _, key in keys], chunksize=chunksize)
+            for (owner, _), error in zip(keys, errors):
+                if error:
+                    self._conflict(f"Invalid ssh key for {owner}: {error}")
+
+    def validate(self, workers=None) -> List[str]:
+        self.conflicts = []
+        self._check_names()
+        self._check_keys(workers)
+        return self.conflicts
+
+    def run(self) -> List[User]:
+        return User.new_bulk([user.to_entry() for user in self.users])
@@ -0,0 +1,73 @@
+import datetime
+import os
+import struct
+from pathlib import Path
+from time import time
+from typing import List, Tuple
+
+# date (unix time), repo id, operation, length of data, data. Records have a fixed size so concurrent O_APPEND
+# writes never interleave and readers can always tell where the last complete record ends.
+RECORD = struct.Struct('<dIHH496s')
+MAX_DATA_LENGTH = 496
+SUFFIX = '.journal'
+
+
+class JournalRecord(object):
+    __slots__ = ('date', 'repo_id', 'operation', 'data')
+
+    def __init__(self, date, repo_id, operation, data):
+        self.date = date
+        self.repo_id = repo_id
+        self.operation = operation
+        self.data = data
+
+
+class Journal(object):
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def filename(self, day: datetime.date) -> str:
+        return f'{day.isoformat()}{SUFFIX}'
+
+    def files(self) -> List[str]:
+        try:
+            return sorted(name for name in os.listdir(self.path) if name.endswith(SUFFIX))
+        except FileNotFoundError:
+            return []
+
+    def is_closed(self, name) -> bool:
+        # Writers may still be appending to yesterday's file right after midnight
+        yesterday = datetime.date.today() - datetime.timedelta(days=1)
+        return name < self.filename(yesterday)
+
+    def append(self, repo_id: int, operation: int, data: str):
+        now = time()
+        encoded = data.encode('utf-8')[:MAX_DATA_LENGTH].decode('utf-8', errors='ignore').encode('utf-8')
+        record = RECORD.pack(now, repo_id, operation, len(encoded), encoded)
+        name = self.filename(datetime.date.fromtimestamp(now))
+        fd = os.open(self.path.joinpath(name), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, record)
+        finally:
+            os.close(fd)
+
+    def read(self, name: str, offset: int = 0) -> Tuple[List[JournalRecord], int]:
+        # Returns all complete records after offset and the offset after the last complete record
+        try:
+            with open(self.path.joinpath(name), 'rb') as f:
+                f.seek(offset)
+                data = f.read()
+        except FileNotFoundError:
+            return [], offset
+        count = len(data) // RECORD.size
+        records = []
+        for date, repo_id, operation, length, raw in RECORD.iter_unpack(data[:count * RECORD.size]):
+            records.append(JournalRecord(datetime.datetime.fromtimestamp(date), repo_id, operation,
+                                         raw[:length].decode('utf-8', errors='replace')))
+        return records, offset + count * RECORD.size
+
+    def remove(self, name: str):
+        try:
+            os.unlink(self.path.joinpath(name))
+        except FileNotFoundError:
+            pass
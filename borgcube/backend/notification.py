@@ -5,14 +5,18 @@ from subprocess import Popen, PIPE
 from typing import Optional, List
 
 from borgcube.backend.config import cfg as _cfg
-from borgcube.backend.model import Repository, RepoLog, User
-from borgcube.enum import LogOperation
+from borgcube.backend.model import Repository, RepoRow, RepoLog, NotificationState, emit_event
+from borgcube.enum import LogOperation, EventType
 from borgcube.exception import NotificationSendmailError
 
 
 class BaseNotification(ABC):
     @abstractmethod
-    def send_too_old_backups_notification(self, repos: List[Repository], logs: List[Optional[RepoLog]]):
+    def send_too_old_backups_notification(self, repos: List[RepoRow], logs: List[Optional[RepoLog]]):
+        pass
+
+    @abstractmethod
+    def dispatch_quota_warning_notification(self, repos: List[RepoRow]):
         pass
 
 
@@ -34,7 +38,7 @@ class EmailNotification(object):
         if p.returncode != 0:
             raise NotificationSendmailError(stderr)
 
-    def dispatch_too_old_backups_notification(self, repos: [Repository], logs: [Optional[RepoLog]]):
+    def dispatch_too_old_backups_notification(self, repos: [RepoRow], logs: [Optional[RepoLog]]):
         if len(repos) == 1:
             subject = f"[{_cfg['server_name']}] 1 Backup is out of date"
         else:
@@ -44,7 +48,7 @@ class EmailNotification(object):
         now = datetime.now()
 
         for idx in range(len(repos)):
-            repo: Repository = repos[idx]
+            repo: RepoRow = repos[idx]
             log: Optional[RepoLog] = logs[idx]
 
             body += f"* {repo.name}: "
@@ -63,6 +67,20 @@ class EmailNotification(object):
         to_email = self.user.email
         self._send_mail(to_email, subject, body)
 
+    def dispatch_quota_warning_notification(self, repos: [RepoRow]):
+        if len(repos) == 1:
+            subject = f"[{_cfg['server_name']}] 1 Repository is running out of space"
+        else:
+            subject = f"[{_cfg['server_name']}] {len(repos)} Repositories are running out of space"
+        body = f"Your repositories on {_cfg['server_name']} are close to their quota. Backups will fail once a " \
+               f"repository is full:\n\n"
+        for repo in repos:
+            body += f"* {repo.name}: more than {repo.quota_warning_level}% of {repo.quota_gb} GB used\n"
+        body += f"\nYou can prune old archives or raise the quota with 'repo quota <name> <size in GB>'. " \
+                f"If you have any questions please don't hesitate to contact your server administrator: " \
+                f"{_cfg['admin_contact']}\n\nWe wish you a good day."
+        self._send_mail(self.user.email, subject, body)
+
 
 class NotificationDispatcher(object):
     def __init__(self, notification_classes: List[BaseNotification] = None):
@@ -70,31 +88,46 @@ class NotificationDispatcher(object):
             notification_classes = [EmailNotification]
         self.notification_classes = notification_classes
 
-    def dispatch_too_old_backups_notifications(self, users: Optional[List[User]] = None):
-        if users is None:
-            users = User.get_all()
-        now = datetime.now()
-        for user in users:
-            too_old_repos = []
-            too_old_repo_logs = []
-            for repo in Repository.get_all_by_user(user):
-                check_date = now - repo.max_age
-                too_old = False
-                log = None
-                if repo.creation_date < check_date:
-                    log = RepoLog.get_last_entry_for_repo_with_operation(repo, LogOperation.SERVE_MODIFY_SUCCESS)
-                    if not log:
-                        too_old = True
-                    else:
-                        if log.date < check_date:
-                            too_old = True
-                if too_old:
-                    too_old_repos.append(repo)
-                    too_old_repo_logs.append(log)
-            if len(too_old_repos) > 0:
-                for cls in self.notification_classes:
-                    notification = cls(user)
-                    notification.dispatch_too_old_backups_notification(too_old_repos, too_old_repo_logs)
+    def dispatch_too_old_backups_notifications(self, now: datetime = None):
+        # Only users with a repo that became overdue or whose next reminder is due get a mail. The mail lists all
+        # their overdue repos.
+        if now is None:
+            now = datetime.now()
+        user_ids = NotificationState.get_due_user_ids(now)
+        if not user_ids:
+            return
+        overdue = Repository.get_overdue(now, user_ids)
+        last_logs = RepoLog.get_last_entries_with_operation(overdue, LogOperation.SERVE_MODIFY_SUCCESS)
+        repos_by_user = {}
+        for repo in overdue:
+            repos_by_user.setdefault(repo.user_id, []).append(repo)
+        for repos in repos_by_user.values():
+            user = repos[0].user
+            logs = [last_logs.get(repo.id) for repo in repos]
+            for repo, log in zip(repos, logs):
+                emit_event(EventType.BACKUP_OVERDUE, user, repo, last_backup=log.date.isoformat() if log else None,
+                           max_age_days=repo.max_age.days)
+            for cls in self.notification_classes:
+                notification = cls(user)
+                notification.dispatch_too_old_backups_notification(repos, logs)
+            NotificationState.mark_sent(repos, now)
+
+    def dispatch_quota_warnings(self):
+        # borg serve sessions record the highest quota threshold a repo reached. Every level is sent once.
+        repos_by_user = {}
+        for repo in Repository.get_quota_warnings():
+            repos_by_user.setdefault(repo.user_id, []).append(repo)
+        for repos in repos_by_user.values():
+            user = repos[0].user
+            for repo in repos:
+                emit_event(EventType.QUOTA_WARNING, user, repo, level=repo.quota_warning_level, quota=repo.quota)
+            for cls in self.notification_classes:
+                notification = cls(user)
+                notification.dispatch_quota_warning_notification(repos)
+            Repository.mark_quota_warnings_sent(repos)
 
     def cron(self):
+        # Successful backups and quota warnings that are still in the journal
+        RepoLog.ingest_journal()
         self.dispatch_too_old_backups_notifications()
+        self.dispatch_quota_warnings()
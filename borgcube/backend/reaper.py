@@ -0,0 +1,56 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, sleep
+
+
+class RateLimit(object):
+    # Spreads work so that at most rate units are done per second. A rate of 0 is unlimited.
+
+    def __init__(self, rate: int):
+        self.rate = rate
+        self.next = monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self, amount: int):
+        if not self.rate:
+            return
+        with self.lock:
+            now = monotonic()
+            start = max(self.next, now)
+            self.next = start + amount / self.rate
+        if start > now:
+            sleep(start - now)
+
+
+class Reaper(object):
+    # Deletes directories from the trash. Files are unlinked by several workers, limited to rate bytes per second so
+    # that deleting a big repository doesn't take the disk away from running backups.
+
+    def __init__(self, workers=4, rate=0):
+        self.workers = workers
+        self.rate_limit = RateLimit(rate)
+
+    def _unlink(self, path: str) -> int:
+        try:
+            size = os.lstat(path).st_size
+        except FileNotFoundError:
+            return 0
+        self.rate_limit.wait(size)
+        os.unlink(path)
+        return size
+
+    def purge(self, path: str) -> int:
+        # Returns the number of bytes freed
+        if not os.path.lexists(path):
+            return 0
+        if os.path.islink(path) or not os.path.isdir(path):
+            return self._unlink(path)
+        freed = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+                # Symlinks to directories are listed in dirnames but not walked into
+                files = filenames + [name for name in dirnames if os.path.islink(os.path.join(dirpath, name))]
+                freed += sum(executor.map(self._unlink, [os.path.join(dirpath, name) for name in files]))
+                os.rmdir(dirpath)
+        return freed
@@ -0,0 +1,190 @@
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from borgcube.exception import StorageError
+
+# ioctl to share the data blocks of two files (reflink) on btrfs, xfs and others
+FICLONE = 0x40049409
+
+# Borg locks are only valid in the directory they were taken in
+SKIPPED_FILES = {'lock.exclusive', 'lock.roster'}
+
+# Files of a borg transaction, e.g. index.1234
+TRANSACTION_FILES = ('index', 'hints', 'integrity')
+
+
+def _copy_data(fsrc, fdst, size):
+    try:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        return
+    except OSError:
+        pass
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    offset = 0
+    while offset < size:
+        try:
+            if copy_file_range:
+                copied = copy_file_range(fsrc.fileno(), fdst.fileno(), size - offset, offset, offset)
+            else:
+                copied = os.sendfile(fdst.fileno(), fsrc.fileno(), offset, size - offset)
+        except OSError as e:
+            if copy_file_range and e.errno in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                copy_file_range = None
+                continue
+            raise
+        if copied == 0:
+            break
+        offset += copied
+
+
+def copy_file(src: Path, dst: Path):
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        _copy_data(fsrc, fdst, os.fstat(fsrc.fileno()).st_size)
+    shutil.copystat(src, dst)
+
+
+def file_checksum(path: Path) -> str:
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+class RepoCopy(object):
+    # Copies a borg repository directory. sync() can run repeatedly: only files with a different size or mtime are
+    # copied again, so a first pass without lock copies the bulk of the (immutable) segments and a second pass under
+    # the repository lock only has to copy what changed in between.
+
+    def __init__(self, src: Path, dst: Path, workers=8):
+        self.src = Path(src)
+        self.dst = Path(dst)
+        self.workers = workers
+
+    @staticmethod
+    def _list(root: Path) -> Dict[str, Tuple[int, int]]:
+        files = {}
+        for dirpath, dirnames, filenames in os.walk(root):
+            for name in filenames:
+                if name in SKIPPED_FILES:
+                    continue
+                path = os.path.join(dirpath, name)
+                stat = os.lstat(path)
+                files[os.path.relpath(path, root)] = (stat.st_size, stat.st_mtime_ns)
+        return files
+
+    def _map(self, func, items) -> list:
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(func, items))
+
+    def _copy(self, name):
+        dst = self.dst.joinpath(name)
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        copy_file(self.src.joinpath(name), dst)
+
+    def sync(self) -> List[str]:
+        # Returns the files that have been copied
+        src_files = self._list(self.src)
+        dst_files = self._list(self.dst) if self.dst.exists() else {}
+        changed = [name for name, stat in src_files.items() if dst_files.get(name) != stat]
+        for name in dst_files.keys() - src_files.keys():
+            os.unlink(self.dst.joinpath(name))
+        self.dst.mkdir(parents=True, exist_ok=True)
+        self._map(self._copy, changed)
+        return changed
+
+    def _differs(self, name) -> bool:
+        return file_checksum(self.src.joinpath(name)) != file_checksum(self.dst.joinpath(name))
+
+    def discard_mismatches(self, names: List[str]) -> List[str]:
+        # Removes copies that don't match the source anymore, so the next sync copies them again
+        mismatches = [name for name, differs in zip(names, self._map(self._differs, names)) if differs]
+        for name in mismatches:
+            os.unlink(self.dst.joinpath(name))
+        return mismatches
+
+    def verify(self, names: List[str]):
+        src_files = self._list(self.src)
+        dst_files = self._list(self.dst)
+        if {name: stat[0] for name, stat in src_files.items()} != {name: stat[0] for name, stat in dst_files.items()}:
+            raise StorageError(f"Copy of '{self.src}' in '{self.dst}' has different files or sizes")
+        mismatches = [name for name, differs in zip(names, self._map(self._differs, names)) if differs]
+        if mismatches:
+            raise StorageError(f"Checksum mismatch after copying '{self.src}': {', '.join(mismatches)}")
+
+
+class RepoMirror(RepoCopy):
+    # Keeps a copy of a borg repository up to date. Committed segments are never changed, so only segments newer than
+    # the last mirrored transaction are copied and segments that compaction removed are deleted. The files of the
+    # transaction are copied after its segments and old ones are deleted last, so the mirror is a usable repository
+    # at any time.
+
+    @staticmethod
+    def _segments(root: Path) -> Dict[int, str]:
+        segments = {}
+        data = root.joinpath('data')
+        if not data.is_dir():
+            return segments
+        for directory in os.scandir(data):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                if entry.name.isdigit():
+                    segments[int(entry.name)] = os.path.join('data', directory.name, entry.name)
+        return segments
+
+    @staticmethod
+    def _top_files(root: Path) -> Dict[str, Tuple[int, int]]:
+        files = {}
+        for entry in os.scandir(root):
+            if entry.is_file(follow_symlinks=False) and entry.name not in SKIPPED_FILES:
+                stat = entry.stat(follow_symlinks=False)
+                files[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        return files
+
+    def _copy(self, name):
+        # Through a temporary file, so an interrupted copy is never taken for a complete one
+        dst = self.dst.joinpath(name)
+        tmp = dst.with_name(f'.{dst.name}.tmp')
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        copy_file(self.src.joinpath(name), tmp)
+        os.replace(tmp, dst)
+
+    def mirror(self, transaction_id: int, mirrored_transaction_id: Optional[int]) -> Tuple[List[str], List[str]]:
+        # Brings the mirror from mirrored_transaction_id to transaction_id. Returns the copied and deleted files.
+        if mirrored_transaction_id is not None and mirrored_transaction_id > transaction_id and self.dst.exists():
+            # The repository has been created again, segment numbers start over
+            shutil.rmtree(self.dst)
+        if not self.dst.exists():
+            mirrored_transaction_id = None
+        self.dst.mkdir(parents=True, exist_ok=True)
+        src_segments = self._segments(self.src)
+        dst_segments = self._segments(self.dst)
+        since = -1 if mirrored_transaction_id is None else mirrored_transaction_id
+        # Segments above transaction_id are still being written
+        segments = [name for number, name in src_segments.items()
+                    if number <= transaction_id and (number > since or number not in dst_segments)]
+        self._map(self._copy, segments)
+
+        src_files = self._top_files(self.src)
+        dst_files = self._top_files(self.dst)
+        current = {f'{prefix}.{transaction_id}' for prefix in TRANSACTION_FILES}
+        files = [name for name, stat in src_files.items()
+                 if (name in current or not name.startswith(TRANSACTION_FILES)) and dst_files.get(name) != stat]
+        missing = current - src_files.keys() - {'integrity.%d' % transaction_id}
+        if missing:
+            raise StorageError(f"Transaction {transaction_id} of '{self.src}' has been replaced while mirroring")
+        self._map(self._copy, files)
+
+        deleted = [name for number, name in dst_segments.items() if number not in src_segments]
+        deleted += [name for name in dst_files
+                    if name not in src_files or (name.startswith(TRANSACTION_FILES) and name not in current)]
+        for name in deleted:
+            os.unlink(self.dst.joinpath(name))
+        return segments + files, deleted
@@ -0,0 +1,79 @@
+import math
+from typing import Dict, Optional, Tuple
+
+from borgcube.exception import ConfigError
+
+SLOT_MINUTES = 5
+DAY_MINUTES = 24 * 60
+
+
+def _parse_time(value: str) -> int:
+    hours, minutes = value.strip().split(':')
+    hours, minutes = int(hours), int(minutes)
+    if not 0 <= hours < 24 or not 0 <= minutes < 60:
+        raise ValueError(value)
+    return hours * 60 + minutes
+
+
+def parse_window(window: str) -> Tuple[int, int]:
+    # 'HH:MM-HH:MM' as (start, length) in minutes, the end may be on the next day
+    try:
+        start, end = [_parse_time(value) for value in window.split('-')]
+    except ValueError:
+        raise ConfigError(f"Invalid schedule_window '{window}', expected e.g. '22:00-06:00'")
+    return start, (end - start) % DAY_MINUTES or DAY_MINUTES
+
+
+def format_time(minutes: int) -> str:
+    return f"{minutes // 60 % 24:02d}:{minutes % 60:02d}"
+
+
+class SlotPlanner(object):
+    # Spreads backup sessions over the backup window. Longest sessions first, every repo gets the start slot where it
+    # overlaps the fewest sessions planned so far and, among those, is farthest away from them. A repo keeps its
+    # current slot as long as that overlaps no more sessions than the best one, so slots only move when it helps.
+
+    def __init__(self, start: int, length: int, slot_minutes=SLOT_MINUTES):
+        self.start = start
+        self.slot_minutes = slot_minutes
+        self.slots = max(1, length // slot_minutes)
+
+    def _slot_of(self, minutes: Optional[int]) -> Optional[int]:
+        if minutes is None:
+            return None
+        offset = (minutes - self.start) % DAY_MINUTES
+        if offset % self.slot_minutes or offset // self.slot_minutes >= self.slots:
+            return None
+        return offset // self.slot_minutes
+
+    def _best_slot(self, load, span, preferred: Optional[int]) -> int:
+        # Sessions overlapped by each start slot, with a sliding sum over the span
+        overlap = [sum(load[:span])]
+        for slot in range(1, self.slots - span + 1):
+            overlap.append(overlap[-1] + load[slot + span - 1] - load[slot - 1])
+        least = min(overlap)
+        if preferred is not None and preferred < len(overlap) and overlap[preferred] == least:
+            return preferred
+        # Free slots before and after every slot, the window edges count as taken
+        free_before = [0] * self.slots
+        for slot in range(1, self.slots):
+            free_before[slot] = free_before[slot - 1] + 1 if load[slot - 1] == 0 else 0
+        free_after = [0] * self.slots
+        for slot in range(self.slots - 2, -1, -1):
+            free_after[slot] = free_after[slot + 1] + 1 if load[slot + 1] == 0 else 0
+        return min((slot for slot in range(len(overlap)) if overlap[slot] == least),
+                   key=lambda slot: (-min(free_before[slot], free_after[slot + span - 1]), slot))
+
+    def plan(self, durations: Dict[int, float], current: Dict[int, Optional[int]] = None) -> Dict[int, int]:
+        # durations are the expected session lengths in seconds and current the planned starts by repo id. Returns
+        # the start of every repo in minutes after midnight.
+        current = current or {}
+        load = [0] * self.slots
+        planned = {}
+        for repo_id in sorted(durations, key=lambda repo_id: (-durations[repo_id], repo_id)):
+            span = min(self.slots, max(1, math.ceil(durations[repo_id] / 60 / self.slot_minutes)))
+            slot = self._best_slot(load, span, self._slot_of(current.get(repo_id)))
+            for i in range(slot, slot + span):
+                load[i] += 1
+            planned[repo_id] = (self.start + slot * self.slot_minutes) % DAY_MINUTES
+        return planned
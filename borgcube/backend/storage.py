@@ -1,20 +1,48 @@
-from contextlib import contextmanager
+from contextlib import contextmanager, nullcontext, ExitStack
+from datetime import datetime
 from pathlib import Path
+import fcntl
+import mmap
 import shutil
 
 import os
-from typing import Optional
+from typing import Optional, Dict, List, Iterable, Tuple
 
 from borg.repository import Repository
 from borg.helpers import Error
 from borg.locking import LockError
 import borg.logger
 from borg.helpers import msgpack
-from borgcube.exception import StorageError, StorageInconsistencyError
+from borgcube.backend.disk_usage import DiskUsageScanner
+from borgcube.backend.relocate import RepoCopy, RepoMirror
+from borgcube.exception import StorageError, StorageInconsistencyError, StorageLockedError
 
 
 borg.logger.setup_logging()
 
+HINTS_READ_SIZE = 64 * 1024
+
+
+def read_hints(path, keys: Iterable[bytes]) -> Dict[bytes, object]:
+    # Reads only the requested top level keys of a borg hints file. The segments and compact maps of big repos are
+    # skipped inside the unpacker without building python objects, so memory stays at about HINTS_READ_SIZE.
+    wanted = set(keys)
+    result = {}
+    with open(path, 'rb') as fd:
+        if os.fstat(fd.fileno()).st_size == 0:
+            raise ValueError(f"Hints file {path} is empty")
+        with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            unpacker = msgpack.Unpacker(mm, read_size=HINTS_READ_SIZE, raw=True)
+            for _ in range(unpacker.read_map_header()):
+                key = unpacker.unpack()
+                if key in wanted:
+                    result[key] = unpacker.unpack()
+                    if len(result) == len(wanted):
+                        break
+                else:
+                    unpacker.skip()
+    return result
+
 
 class BorgRepo(object):
     def __init__(self, path, lock_wait=5):
@@ -26,13 +54,18 @@ class BorgRepo(object):
     @property
     def quota_used(self):
         if self.is_repo:
-            return self._get_borg_repo_hints()[b'storage_quota_use']
+            return self._get_borg_repo_hints([b'storage_quota_use'])[b'storage_quota_use']
         return 0
 
     @property
     def is_repo(self):
         return self.__repo is not None
 
+    @property
+    def quota(self) -> int:
+        with self.open_no_lock():
+            return self.__quota
+
     @property
     def __quota(self):
         return self.__repo.config.getint('repository', 'storage_quota', fallback=0)
@@ -42,13 +75,11 @@ class BorgRepo(object):
         self.__repo.config.set('repository', 'storage_quota', str(new_quota))
         self.__repo.save_config(self.__repo.path, self.__repo.config)
 
-    def _get_borg_repo_hints(self):
+    def _get_borg_repo_hints(self, keys: Iterable[bytes]):
         if self.is_repo:
             transaction_id = self.__repo.get_index_transaction_id()
             hints_path = os.path.join(self.path, 'hints.%d' % transaction_id)
-            with open(hints_path, 'rb') as fd:
-                hints = msgpack.unpack(fd)
-            return hints
+            return read_hints(hints_path, keys)
         return None
 
     @property
@@ -61,12 +92,22 @@ class BorgRepo(object):
             self.__repo.open(self.__repo.path, exclusive=True, lock_wait=self.__repo.lock_wait)
             yield
         except LockError as e:
-            raise StorageError(e)
+            raise StorageLockedError(e)
         except Error as e:
             raise StorageError(e)
         finally:
             self.__repo.close()
 
+    def discard(self):
+        # The repository directory has been renamed away to be deleted while it was locked. Its lock is deleted with
+        # it, releasing it would look for the lock files at the old path. This relies on the internals of borg 1.x.
+        if not hasattr(self.__repo, 'io') or not hasattr(self.__repo, 'lock'):
+            raise StorageError("Unsupported borg version, cannot discard a locked repository")
+        if self.__repo.io:
+            self.__repo.io.close()
+            self.__repo.io = None
+        self.__repo.lock = None
+
     @contextmanager
     def open_no_lock(self):
         try:
@@ -87,42 +128,269 @@ class BorgRepo(object):
                 raise StorageError(f"Can't set new quota: New quota too small. "
                                    f"Smallest quota would be {self.quota_used}")
 
+    def set_quota(self, new_quota):
+        # Unlike set_new_quota_safe this doesn't compare with the used space, the database value is already in effect
+        with self.open_locked():
+            self.__quota = new_quota
+
     def get_quota_used(self):
         if not self.__repo:
             raise StorageError("Repository has not been initialized yet")
 
 
 class Storage(object):
-    def __init__(self, path):
+    PLACEMENT_FREE_SPACE = 'free_space'
+    PLACEMENT_ALLOCATED = 'allocated'
+    PLACEMENT_ROUND_ROBIN = 'round_robin'
+
+    def __init__(self, path, volumes: List[str] = None, placement=PLACEMENT_FREE_SPACE, mirror_path: str = None):
         self.path = Path(path)
+        # storage_path is always the first volume. It also holds the database, the journal and the home directory.
+        self.volumes = [str(self.path)] + [str(volume) for volume in volumes or [] if str(volume) != str(self.path)]
+        if placement not in (self.PLACEMENT_FREE_SPACE, self.PLACEMENT_ALLOCATED, self.PLACEMENT_ROUND_ROBIN):
+            raise StorageError(f"Unknown storage placement '{placement}'")
+        self.placement = placement
         self.backups_path = self.path.joinpath('backups')
         self.home_path = self.path.joinpath('home')
         self.ssh_path = self.home_path.joinpath('.ssh')
+        self.journal_path = self.path.joinpath('journal')
+        self.outbox_path = self.path.joinpath('outbox')
+        self.mirror_path = Path(mirror_path) if mirror_path else None
+        # Same file system as the mirrors, user names can't start with a dot
+        self.mirror_trash_path = self.mirror_path.joinpath('.trash') if mirror_path else None
         self.create_if_needed()
+        self.disk_usage_scanner = DiskUsageScanner(self.path.joinpath('disk_usage.json'))
 
     def create_if_needed(self):
         self.path.mkdir(exist_ok=True)
         self.backups_path.mkdir(exist_ok=True)
         self.home_path.mkdir(exist_ok=True)
         self.ssh_path.mkdir(exist_ok=True, mode=0o700)
-
-    def create_user(self, user_name):
-        self.user_path(user_name).mkdir()
-
-    def delete_user(self, user_name):
-        shutil.rmtree(self.user_path(user_name))
-
-    def user_path(self, user_name):
-        return self.backups_path.joinpath(user_name)
-
-    def repo_path(self, user_name, repo_name):
-        return self.backups_path.joinpath(user_name).joinpath(repo_name)
-
-    def delete_repo(self, user_name, repo_name):
-        shutil.rmtree(self.repo_path(user_name, repo_name))
+        self.journal_path.mkdir(exist_ok=True)
+        for volume in self.volumes:
+            self.volume_backups_path(volume).mkdir(parents=True, exist_ok=True)
+
+    def volume_backups_path(self, volume: Optional[str] = None) -> Path:
+        if volume is None:
+            return self.backups_path
+        if volume not in self.volumes:
+            raise StorageError(f"Storage volume '{volume}' is not configured")
+        return Path(volume).joinpath('backups')
+
+    @staticmethod
+    def volume_free_space(volume: str) -> int:
+        stat = os.statvfs(volume)
+        return stat.f_bavail * stat.f_frsize
+
+    def choose_volume(self, allocation: Dict[Optional[str], tuple]) -> Optional[str]:
+        # allocation maps volumes to (user count, allocated quota). The primary volume is stored as None.
+        def key(volume):
+            count, quota = allocation.get(None if volume == self.volumes[0] else volume, (0, 0))
+            if self.placement == self.PLACEMENT_ALLOCATED:
+                return quota
+            elif self.placement == self.PLACEMENT_ROUND_ROBIN:
+                return count
+            return -self.volume_free_space(volume)
+        volume = min(self.volumes, key=key)
+        return None if volume == self.volumes[0] else volume
+
+    def create_user(self, user_name, volume=None):
+        self.user_path(user_name, volume).mkdir()
+
+    def delete_user(self, user_name, volume=None):
+        shutil.rmtree(self.user_path(user_name, volume))
+        if self.mirror_path:
+            shutil.rmtree(self.mirror_path.joinpath(user_name), ignore_errors=True)
+
+    def trash_path(self, volume: Optional[str] = None) -> Path:
+        # Next to the backups directory of the volume, so moving into the trash is a rename
+        return self.volume_backups_path(volume).parent.joinpath('trash')
+
+    @staticmethod
+    def _trash(moves: List[Tuple[Path, Path]]) -> List[Tuple[str, str]]:
+        # Renames every path into its trash directory. Returns (original path, path in the trash) of the moved paths.
+        stamp = datetime.now().strftime('%Y%m%dT%H%M%S%f')
+        moved = []
+        try:
+            for path, trash in moves:
+                if not os.path.lexists(path):
+                    continue
+                trash.mkdir(exist_ok=True)
+                dst = trash.joinpath(f'{stamp}-{path.parent.name}-{path.name}')
+                os.rename(path, dst)
+                moved.append((str(path), str(dst)))
+        except OSError:
+            Storage.restore_from_trash(moved)
+            raise
+        return moved
+
+    def trash_lock(self):
+        # Returns an open lock file or None if the trash of this node is being purged already
+        f = open(self.path.joinpath('trash.lock'), 'w')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return None
+        return f
+
+    @staticmethod
+    def restore_from_trash(moved: List[Tuple[str, str]]):
+        for path, _ in moved:
+            if os.path.lexists(path):
+                raise StorageError(f"Can't restore '{path}': it exists again")
+        for path, trashed in reversed(moved):
+            Path(path).parent.mkdir(exist_ok=True)
+            os.rename(trashed, path)
+
+    def trash_user(self, user_name, volume=None, repo_volumes: List[Tuple[str, str]] = ()) -> List[Tuple[str, str]]:
+        # repo_volumes are (repo name, volume) of the repos that have been moved away from the user's volume
+        moves = [(self.user_path(user_name, volume), self.trash_path(volume))]
+        moves += [(self.repo_path(user_name, repo_name, repo_volume), self.trash_path(repo_volume))
+                  for repo_name, repo_volume in repo_volumes]
+        if self.mirror_path:
+            moves.append((self.mirror_path.joinpath(user_name), self.mirror_trash_path))
+        moved = self._trash(moves)
+        for repo_name, repo_volume in repo_volumes:
+            try:
+                self.user_path(user_name, repo_volume).rmdir()
+            except OSError:
+                # Not empty or already removed
+                pass
+        return moved
+
+    def trash_repo(self, user_name, repo_name, volume=None, repo_volume=None) -> List[Tuple[str, str]]:
+        moves = [(self.repo_path(user_name, repo_name, repo_volume or volume), self.trash_path(repo_volume or volume))]
+        link = self.repo_path(user_name, repo_name, volume)
+        if link.is_symlink():
+            moves.append((link, self.trash_path(volume)))
+        if self.mirror_path:
+            moves.append((self.mirror_repo_path(user_name, repo_name), self.mirror_trash_path))
+        return self._trash(moves)
+
+    def user_path(self, user_name, volume=None):
+        return self.volume_backups_path(volume).joinpath(user_name)
+
+    def repo_path(self, user_name, repo_name, volume=None):
+        return self.user_path(user_name, volume).joinpath(repo_name)
+
+    def delete_repo(self, user_name, repo_name, volume=None, repo_volume=None):
+        # repo_volume is set if the repo has been moved away from the user's volume
+        shutil.rmtree(self.repo_path(user_name, repo_name, repo_volume or volume))
+        link = self.repo_path(user_name, repo_name, volume)
+        if link.is_symlink():
+            link.unlink()
+        if self.mirror_path:
+            shutil.rmtree(self.mirror_repo_path(user_name, repo_name), ignore_errors=True)
+
+    def mirror_repo_path(self, user_name, repo_name) -> Path:
+        return self.mirror_path.joinpath(user_name, repo_name)
+
+    def mirror_repo(self, repo, mirrored_transaction_id: Optional[int], workers=8) -> Tuple[Optional[int], int]:
+        # Returns the transaction that has been mirrored, None if the repo hasn't been initialized yet, and the
+        # number of copied files
+        if self.mirror_path is None:
+            raise StorageError("No mirror_path configured")
+        transaction_id = self.get_repo_transaction_id(repo)
+        if transaction_id is None:
+            return None, 0
+        repo_mirror = RepoMirror(repo.path, self.mirror_repo_path(repo.user.name, repo.name), workers)
+        copied, _ = repo_mirror.mirror(transaction_id, mirrored_transaction_id)
+        return transaction_id, len(copied)
+
+    @staticmethod
+    def link_repo(link: Path, target: Path):
+        # Clients address repos relative to the user directory. A moved repo is reachable through a symlink there.
+        tmp = link.with_name(f'.{link.name}.link')
+        if tmp.is_symlink():
+            tmp.unlink()
+        tmp.symlink_to(os.path.abspath(target))
+        os.replace(tmp, link)
+
+    def move_repo(self, repo, volume, lock_wait=60):
+        user_volume = repo.user.volume or self.volumes[0]
+        self.volume_backups_path(volume)
+        src = repo.path
+        dst = self.repo_path(repo.user.name, repo.name, volume)
+        if src == dst:
+            raise StorageError(f"Repository '{repo.name}' is already on volume '{volume}'")
+        link = self.repo_path(repo.user.name, repo.name, repo.user.volume)
+        dst.parent.mkdir(exist_ok=True)
+        repo_copy = RepoCopy(src, dst.with_name(f'.{dst.name}.moving'))
+
+        # Copy everything without lock first. Only files that changed in the meantime are copied while locked.
+        copied = repo_copy.sync()
+        repo_copy.discard_mismatches(copied)
+
+        borg_repo = BorgRepo(src, lock_wait=lock_wait)
+        if borg_repo.is_repo:
+            locked = borg_repo.open_locked()
+        else:
+            locked = nullcontext()
+        old = src.with_name(f'.{src.name}.old')
+        with repo.lock(), locked:
+            copied = repo_copy.sync()
+            repo_copy.verify(copied)
+            if dst.is_symlink():
+                dst.unlink()
+            os.rename(repo_copy.dst, dst)
+            repo.volume = None if volume == user_volume else volume
+            repo.save(only=[type(repo).volume])
+            # A borg serve waiting for the lock must not get the old copy. Once it is renamed away the waiting
+            # session either fails or, through the link, locks the new copy.
+            os.rename(src, old)
+            if dst != link:
+                self.link_repo(link, dst)
+            if borg_repo.is_repo:
+                borg_repo.discard()
+        shutil.rmtree(old)
+        if src.parent != link.parent:
+            try:
+                src.parent.rmdir()
+            except OSError:
+                # Other repos of the user are still on this volume
+                pass
+
+    def move_user(self, user, node, dst_storage: 'Storage', lock_wait=60):
+        # Moves the storage of a user to the storage of another node, like move_repo but for all repos at once
+        repos = list(user.repos)
+        if any(repo.volume for repo in repos):
+            raise StorageError(f"Repositories of user '{user.name}' have been moved to other volumes")
+        src = user.path
+        dst = dst_storage.user_path(user.name)
+        if dst.exists():
+            raise StorageError(f"'{dst}' already exists")
+        user_copy = RepoCopy(src, dst.with_name(f'.{dst.name}.moving'))
+
+        copied = user_copy.sync()
+        user_copy.discard_mismatches(copied)
+
+        old = src.with_name(f'.{src.name}.old')
+        with ExitStack() as stack:
+            stack.enter_context(user.lock())
+            borg_repos = []
+            for repo in repos:
+                stack.enter_context(repo.lock())
+                borg_repo = BorgRepo(repo.path, lock_wait=lock_wait)
+                if borg_repo.is_repo:
+                    stack.enter_context(borg_repo.open_locked())
+                    borg_repos.append(borg_repo)
+            copied = user_copy.sync()
+            user_copy.verify(copied)
+            os.rename(user_copy.dst, dst)
+            user.node = node
+            user.volume = None
+            user.save(only=[type(user).node, type(user).volume])
+            # borg serve on the old node refuses the user from here on, sessions waiting for a lock fail
+            os.rename(src, old)
+            for borg_repo in borg_repos:
+                borg_repo.discard()
+        shutil.rmtree(old)
+        if self.mirror_path:
+            shutil.rmtree(self.mirror_path.joinpath(user.name), ignore_errors=True)
 
     def get_borg_repo(self, repo):
-        borg_repo = BorgRepo(self.repo_path(repo.user.name, repo.name))
+        borg_repo = BorgRepo(repo.path)
         return borg_repo
 
     def get_quota_used(self, repo):
@@ -132,6 +400,11 @@ class Storage(object):
                 return borg_repo.quota_used
         return 0
 
+    def disk_usage(self, paths: List[Path] = None) -> Dict[Path, int]:
+        if paths is None:
+            paths = [self.volume_backups_path(volume) for volume in self.volumes] + [self.home_path]
+        return self.disk_usage_scanner.scan(paths)
+
     def get_repo_transaction_id(self, repo):
         borg_repo = self.get_borg_repo(repo)
         if borg_repo.is_repo:
@@ -139,15 +412,32 @@ class Storage(object):
                 return borg_repo.transaction_id
         return None
 
-    def set_new_quota(self, repo, new_quota):
+    def get_repo_session_state(self, repo) -> Tuple[Optional[int], Optional[int]]:
+        # Transaction id and used quota with one open of the repo. The used quota is None if there are no hints yet.
         borg_repo = self.get_borg_repo(repo)
         if borg_repo.is_repo:
-            with borg_repo.open_locked():
-                if borg_repo.quota_used <= new_quota:
-                    borg_repo.set_new_quota_safe(new_quota)
+            with borg_repo.open_no_lock():
+                transaction_id = borg_repo.transaction_id
+                try:
+                    quota_used = borg_repo.quota_used
+                except (OSError, ValueError, KeyError):
+                    quota_used = None
+            return transaction_id, quota_used
+        return None, None
+
+    @staticmethod
+    def apply_quota(repo, quota: int) -> bool:
+        # Writes the quota to the borg config without waiting for the repo lock. Returns False if the repo is in use.
+        borg_repo = BorgRepo(repo.path, lock_wait=0)
+        if borg_repo.is_repo:
+            try:
+                borg_repo.set_quota(quota)
+            except StorageLockedError:
+                return False
+        return True
 
     def assert_consistency_for_user(self, user):
-        user_path = self.user_path(user.name)
+        user_path = user.path
         if not user_path.is_dir():
             raise StorageInconsistencyError(f"Storage for user '{user.name}' is missing")
 
@@ -157,6 +447,9 @@ class Storage(object):
                                             f"repos but {len(repos)} were found")
 
         for file in user_path.iterdir():
+            if file.name.startswith('.'):
+                # Leftovers of a repository move
+                continue
             if not file.is_dir():
                 raise StorageInconsistencyError(f"Stale file '{file.name}' found in user directory of '{user.name}'")
             if file.name not in [repo.name for repo in repos]:
@@ -31,3 +31,14 @@ class LogOperation(Enum):
     CALC_QUOTA_END = 14
     SERVE_MODIFY_SUCCESS = 15
     SERVE_MODIFY_ABORT = 16
+    QUOTA_WARNING = 17
+    UNDELETE_REPO = 18
+    UNDELETE_USER = 19
+
+
+class EventType(Enum):
+    SERVE_REPO_ABORT = 'serve_repo_abort'
+    BACKUP_OVERDUE = 'backup_overdue'
+    REPO_QUOTA_CHANGED = 'repo_quota_changed'
+    USER_QUOTA_CHANGED = 'user_quota_changed'
+    QUOTA_WARNING = 'quota_warning'
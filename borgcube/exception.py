@@ -34,7 +34,15 @@ class StorageInconsistencyError(StorageError):
     pass
 
 
-class ConfigFileDoesNotExistError(BorgcubeError):
+class StorageLockedError(StorageError):
+    pass
+
+
+class ConfigError(BorgcubeError):
+    pass
+
+
+class ConfigFileDoesNotExistError(ConfigError):
     pass
 
 
@@ -51,4 +59,12 @@ class NotificationError(BorgcubeError):
 
 
 class NotificationSendmailError(NotificationError):
-    pass
\ No newline at end of file
+    pass
+
+
+class ImportFileError(BorgcubeError):
+    pass
+
+
+class ClusterError(BorgcubeError):
+    pass
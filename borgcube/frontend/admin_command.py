@@ -1,10 +1,17 @@
 import argparse
+import json
+import math
 from datetime import datetime, timedelta
 
-from borgcube.backend.model import User, DatabaseError, UserLog, Repository, RepoLog, AdminLog
+from borgcube.backend.model import User, DatabaseError, UserLog, Repository, RepoLog, AdminLog, UsageSample, \
+    FleetView, MirrorState, TrashEntry, assert_consistent, emit_event, dispatch_events, _outbox, _storage
 from borgcube.backend.authorized_keys import AuthorizedKeyType, AuthorizedKeysFile
+from borgcube.backend.cluster import cluster as _cluster
+from borgcube.backend.config import cfg as _cfg
+from borgcube.backend.importer import BulkImport
+from borgcube.backend.slots import format_time
 from borgcube.backend.notification import NotificationDispatcher
-from borgcube.enum import LogOperation
+from borgcube.enum import LogOperation, EventType
 from borgcube.exception import AdminCommandError
 from borgcube.frontend.base_command import BaseCommand
 from borgcube.frontend.shell import Shell
@@ -21,6 +28,12 @@ class AdminCommand(BaseCommand):
         parse_cron = subparsers.add_parser('cron')
         parse_cron.set_defaults(func=self._command_cron)
 
+        parse_broker = subparsers.add_parser('broker', help="Answer borg serve connections from a warm process")
+        parse_broker.set_defaults(func=self._command_broker)
+
+        parse_daemon = subparsers.add_parser('daemon', help="Run periodic jobs in the foreground")
+        parse_daemon.set_defaults(func=self._command_daemon)
+
         parse_log = subparsers.add_parser('log')
         parse_log.set_defaults(func=self._command_log_read, logfile=None)
         parse_log_subparsers = parse_log.add_subparsers()
@@ -37,6 +50,41 @@ class AdminCommand(BaseCommand):
         parse_log_admin = parse_log_subparsers.add_parser('admin')
         parse_log_admin.set_defaults(logfile='admin')
 
+        parse_forecast = subparsers.add_parser('forecast', help="List repos predicted to run out of quota")
+        parse_forecast.set_defaults(func=self._command_forecast)
+        parse_forecast.add_argument('days', nargs='?', type=int, default=7, help="Forecast horizon in days")
+        parse_forecast.add_argument('--window', type=int, default=30, help="Days of usage history to consider")
+
+        parse_fsck = subparsers.add_parser('fsck', help="Check database, storage and borg configs for inconsistencies")
+        parse_fsck.set_defaults(func=self._command_fsck)
+        parse_fsck.add_argument('--repair', action='store_true', help="Fix the issues that can be fixed safely")
+        parse_fsck.add_argument('--workers', type=int, default=8)
+
+        parse_events = subparsers.add_parser('events', help="Show and deliver queued events")
+        parse_events.set_defaults(func=self._command_events)
+        parse_events.add_argument('--dispatch', action='store_true', help="Deliver due events now")
+        parse_events.add_argument('--retry-failed', action='store_true',
+                                  help="Queue events again that failed too often")
+
+        parse_mirror = subparsers.add_parser('mirror', help="Show the mirror lag of all repos")
+        parse_mirror.set_defaults(func=self._command_mirror)
+        parse_mirror.add_argument('--sync', action='store_true', help="Mirror repos with new transactions now")
+        parse_mirror.add_argument('--json', action='store_true', help="Print the mirror states as JSON")
+
+        parse_schedule = subparsers.add_parser('schedule', help="Show the planned backup slots of all repos")
+        parse_schedule.set_defaults(func=self._command_schedule)
+        parse_schedule.add_argument('--plan', action='store_true', help="Plan the slots now")
+        parse_schedule.add_argument('--json', action='store_true', help="Print the slots as JSON")
+
+        parse_trash = subparsers.add_parser('trash', help="Show deleted users and repos waiting to be purged")
+        parse_trash.set_defaults(func=self._command_trash)
+        parse_trash.add_argument('--purge', action='store_true', help="Purge entries whose grace period is over")
+        parse_trash.add_argument('--purge-all', action='store_true', help="Purge all entries of this node")
+
+        parse_undelete = subparsers.add_parser('undelete', help="Restore a deleted user or repo from the trash")
+        parse_undelete.set_defaults(func=self._command_undelete)
+        parse_undelete.add_argument('id', type=int, help="Trash entry, see 'trash'")
+
         parse_regen = subparsers.add_parser('regen')
         parse_regen.set_defaults(func=self._command_regen)
 
@@ -53,6 +101,43 @@ class AdminCommand(BaseCommand):
         parse_user_add.add_argument('email', help="Email of the user")
         parse_user_add.add_argument('quota', help="Initial quota value in gb")
         parse_user_add.add_argument('key', nargs="*", help="SSH key for the user")
+        parse_user_add.add_argument('--node', help="Cluster node to store the user on, see 'node list'")
+
+        parse_import = subparsers.add_parser('import', help="Create users and repos from a YAML or CSV file")
+        parse_import.set_defaults(func=self._command_import)
+        parse_import.add_argument('file', help="YAML or CSV file with users and repos")
+        parse_import.add_argument('--format', choices=['yaml', 'csv'], help="File format, guessed from extension")
+        parse_import.add_argument('--dry-run', action='store_true', help="Only report conflicts")
+
+        parse_repo = subparsers.add_parser('repo', help="Repository commands")
+        parse_repo_subparsers = parse_repo.add_subparsers()
+
+        parse_repo_move = parse_repo_subparsers.add_parser('move', help="Move a repository to another volume")
+        parse_repo_move.set_defaults(func=self._command_repo_move)
+        parse_repo_move.add_argument('user')
+        parse_repo_move.add_argument('repo')
+        parse_repo_move.add_argument('volume', help="Destination volume, see 'volumes'")
+
+        parse_volumes = subparsers.add_parser('volumes', help="List storage volumes")
+        parse_volumes.set_defaults(func=self._command_volumes)
+
+        parse_node = subparsers.add_parser('node', help="Cluster node commands")
+        parse_node.set_defaults(func=self._command_node_list)
+        parse_node_subparsers = parse_node.add_subparsers()
+
+        parse_node_list = parse_node_subparsers.add_parser('list', help="List cluster nodes and their users")
+        parse_node_list.set_defaults(func=self._command_node_list)
+
+        parse_node_move = parse_node_subparsers.add_parser('move', help="Move a user to another node")
+        parse_node_move.set_defaults(func=self._command_node_move)
+        parse_node_move.add_argument('user')
+        parse_node_move.add_argument('node')
+
+        parse_node_rebalance = parse_node_subparsers.add_parser('rebalance',
+                                                                help="Even out the allocated quota of the nodes")
+        parse_node_rebalance.set_defaults(func=self._command_node_rebalance)
+        parse_node_rebalance.add_argument('--apply', action='store_true', help="Move the users, default is to only "
+                                                                               "print the planned moves")
 
         parse_user_add = subparsers.add_parser('quota')
         parse_user_add.set_defaults(func=self._command_user_quota)
@@ -68,14 +153,19 @@ class AdminCommand(BaseCommand):
 
     @staticmethod
     def _print_user_headline():
-        print(f"{'USER':<21}{'REPOS':<10}{'USAGE':<10}{'ALLOC':<10}{'QUOTA'}")
+        print(f"{'USER':<21}{'REPOS':<10}{'USAGE':<10}{'DISK':<10}{'ALLOC':<10}{'QUOTA'}")
 
     @staticmethod
-    def _print_user_line(user):
+    def _print_user_line(user, disk_usage=None):
+        if disk_usage is None:
+            disk_usage = user.disk_usage
+        repos = list(user.repos)
+        allocated = sum(repo.quota for repo in repos)
         print(f"{user.name:<21}"
-              f"{len(user.repos):<10}"
-              f"{(str(user.quota_used_gb) + ' GB'):<10}"
-              f"{str(user.quota_allocated_gb) + ' GB':<10}"
+              f"{len(repos):<10}"
+              f"{(str(math.floor(sum(repo.quota_used for repo in repos) / 1000 / 1000 / 1000)) + ' GB'):<10}"
+              f"{(str(math.floor(disk_usage / 1000 / 1000 / 1000)) + ' GB'):<10}"
+              f"{str(math.floor(allocated / 1000 / 1000 / 1000)) + ' GB':<10}"
               f"{user.quota_gb} GB")
 
     def _parse_env(self):
@@ -108,9 +198,120 @@ class AdminCommand(BaseCommand):
         for line in lines:
             print(line)
 
+    def _command_forecast(self):
+        forecast = UsageSample.forecast(self.args.days, self.args.window)
+        print(f"{'USER':<21}{'REPO':<21}{'USAGE':<10}{'QUOTA':<10}{'GROWTH':<12}{'FULL IN'}")
+        for repo, trend, days_until in forecast:
+            print(f"{repo.user.name:<21}"
+                  f"{repo.name:<21}"
+                  f"{str(math.floor(trend.bytes_now / 1000 / 1000 / 1000)) + ' GB':<10}"
+                  f"{str(repo.quota_gb) + ' GB':<10}"
+                  f"{'%.2f GB/d' % (trend.bytes_per_day / 1000 / 1000 / 1000):<12}"
+                  f"{days_until:.1f} days")
+
+    def _command_fsck(self):
+        from borgcube.backend.fsck import Fsck
+        fsck = Fsck(workers=self.args.workers)
+        fsck.check()
+        if self.args.repair:
+            fsck.repair()
+        print(json.dumps(fsck.report(), indent=2))
+
+    def _command_events(self):
+        if self.args.retry_failed:
+            print(f"Queued {_outbox.retry_failed()} failed events again")
+        if self.args.dispatch:
+            print(f"Delivered {dispatch_events()} events")
+        pending = _outbox.pending()
+        failed = _outbox.failed()
+        print(f"{len(pending)} pending, {len(failed)} failed")
+        for event in failed:
+            print(f"{event.record['id']} {event.record['type']} {event.record.get('last_error', '')}")
+
+    def _command_schedule(self):
+        if self.args.plan:
+            result = Repository.plan_backup_slots()
+            if not self.args.json:
+                print(f"Planned {result['planned']} repos, {result['moved']} got a new slot")
+        repos = FleetView.local().repos
+        durations = RepoLog.get_session_durations([repo.id for repo in repos])
+        if self.args.json:
+            print(json.dumps([{
+                'user': repo.user.name,
+                'repo': repo.name,
+                'slot': format_time(repo.backup_slot) if repo.backup_slot is not None else None,
+                'expected_duration': durations.get(repo.id),
+            } for repo in repos], indent=2))
+            return
+        print(f"Backup window: {_cfg['schedule_window']}")
+        print(f"{'USER':<21}{'REPO':<21}{'SLOT':<8}{'EXPECTED'}")
+        for repo in repos:
+            duration = durations.get(repo.id)
+            print(f"{repo.user.name:<21}"
+                  f"{repo.name:<21}"
+                  f"{format_time(repo.backup_slot) if repo.backup_slot is not None else '-':<8}"
+                  f"{'%.0f min' % (duration / 60) if duration is not None else '-'}")
+
+    def _command_mirror(self):
+        if not _storage.mirror_path:
+            raise AdminCommandError("No mirror configured, see 'mirror_path' in the config file")
+        if self.args.sync:
+            result = MirrorState.mirror_pending()
+            if not self.args.json:
+                print(f"Mirrored {result['mirrored']} repos ({result['files']} files), {result['failed']} failed")
+        now = datetime.now()
+        states = MirrorState.get_all_local()
+        if self.args.json:
+            print(json.dumps([{
+                'user': state.repo.user.name,
+                'repo': state.repo.name,
+                'source_transaction_id': state.source_transaction_id,
+                'transaction_id': state.transaction_id,
+                'date': state.date.isoformat() if state.date else None,
+                'lag': state.get_lag(now),
+                'last_lag': state.lag,
+                'error': state.error,
+            } for state in states], indent=2))
+            return
+        print(f"{'USER':<21}{'REPO':<21}{'SOURCE TX':<12}{'MIRROR TX':<12}{'LAG':<10}{'ERROR'}")
+        for state in states:
+            print(f"{state.repo.user.name:<21}"
+                  f"{state.repo.name:<21}"
+                  f"{str(state.source_transaction_id):<12}"
+                  f"{str(state.transaction_id):<12}"
+                  f"{str(math.ceil(state.get_lag(now))) + ' s':<10}"
+                  f"{state.error or ''}")
+
+    def _command_trash(self):
+        if self.args.purge or self.args.purge_all:
+            result = TrashEntry.purge_expired(purge_all=self.args.purge_all)
+            print(f"Purged {result['purged']} entries ({math.floor(result['bytes'] / 1000 / 1000 / 1000)} GB), "
+                  f"{result['failed']} failed")
+        print(f"{'ID':<8}{'USER':<21}{'REPO':<21}{'DELETED':<21}{'PURGE AFTER'}")
+        for entry in TrashEntry.select().order_by(TrashEntry.id):
+            print(f"{entry.id:<8}"
+                  f"{entry.user_name:<21}"
+                  f"{entry.repo_name or '(user)':<21}"
+                  f"{entry.date.strftime('%Y-%m-%d %H:%M'):<21}"
+                  f"{'purging' if entry.purging else entry.purge_after.strftime('%Y-%m-%d %H:%M')}")
+
+    def _command_undelete(self):
+        entry = TrashEntry.get_or_none(TrashEntry.id == self.args.id)
+        if entry is None:
+            raise AdminCommandError(f"Trash entry {self.args.id} does not exist")
+        try:
+            entry.undelete()
+        except DatabaseError as e:
+            raise AdminCommandError(e)
+        AuthorizedKeysFile(FleetView().users).save_atomic()
+        if entry.repo_name:
+            print(f"Restored repository {entry.repo_name} of user {entry.user_name}")
+        else:
+            print(f"Restored user {entry.user_name}")
+
     @staticmethod
     def _command_regen():
-        authorized_keys = AuthorizedKeysFile(User.get_all())
+        authorized_keys = AuthorizedKeysFile(FleetView().users)
         authorized_keys.save_atomic()
         print("Regenerated authorized_keys file")
 
@@ -124,19 +325,40 @@ class AdminCommand(BaseCommand):
         if self.args.quota:
             quota = int(self.args.quota) * 1000 * 1000 * 1000
         try:
-            user = User.new(name=name, email=email, quota=quota, ssh_key_str=key)
-            authorized_keys_file = AuthorizedKeysFile(User.get_all())
+            user = User.new(name=name, email=email, quota=quota, ssh_key_str=key, node=self.args.node)
+            authorized_keys_file = AuthorizedKeysFile(FleetView().users)
             authorized_keys_file.save_atomic()
         except DatabaseError as e:
             raise AdminCommandError(e)
         user.save()
 
+    def _command_import(self):
+        bulk_import = BulkImport.from_file(self.args.file, self.args.format)
+        conflicts = bulk_import.validate()
+        for conflict in conflicts:
+            print(f"Conflict: {conflict}")
+        if self.args.dry_run:
+            print(f"Dry run: {len(bulk_import.users)} users and {bulk_import.repo_count} repos would be created, "
+                  f"{len(conflicts)} conflicts found")
+            return
+        if conflicts:
+            raise AdminCommandError(f"Import aborted: {len(conflicts)} conflicts found")
+        try:
+            bulk_import.run()
+        except DatabaseError as e:
+            raise AdminCommandError(f"Import failed, no changes were made: {e}")
+        authorized_keys_file = AuthorizedKeysFile(FleetView().users)
+        authorized_keys_file.save_atomic()
+        print(f"Imported {len(bulk_import.users)} users and {bulk_import.repo_count} repos")
+
     def _command_user_quota(self):
         quota = int(self.args.quota)
         try:
             user = User.get_by_name(self.args.name)
+            old_quota = user.quota
             user.quota_gb = quota
             user.save()
+            emit_event(EventType.USER_QUOTA_CHANGED, user, old_quota=old_quota, quota=user.quota)
             print(f"Successfully changed quota of user {user.name} to {user.quota_gb} GB")
         except DatabaseError as e:
             raise AdminCommandError(e)
@@ -152,14 +374,90 @@ class AdminCommand(BaseCommand):
             raise AdminCommandError("\nDo you want to delete this user? Then append CONFIRM to the command line.")
         if user.delete_instance():
             print(f"Successfully deleted user {self.args.name}")
+            if _cfg['trash_grace_days']:
+                print(f"The files are kept for {_cfg['trash_grace_days']} days, see 'borgcube trash'")
         else:
             raise AdminCommandError(f"There was an error deleting the user {self.args.name}.")
 
     def _command_user_list(self):
-        users = User.get_all()
+        users = FleetView.local().users
+        disk_usage = User.get_disk_usage(users)
         self._print_user_headline()
         for user in users:
-            self._print_user_line(user)
+            self._print_user_line(user, disk_usage[user.name])
+
+    def _command_repo_move(self):
+        user = User.get_by_name(self.args.user)
+        repo = Repository.get_by_name(self.args.repo, user)
+        print(f"Moving repository '{repo.name}' of user '{user.name}' to {self.args.volume}")
+        repo.move(self.args.volume)
+        print(f"Repository is now located at {repo.path}")
+
+    @staticmethod
+    def _command_volumes():
+        print(f"{'VOLUME':<41}{'FREE':<12}{'USERS':<10}{'ALLOC'}")
+        for volume, free, count, quota in User.get_volumes():
+            print(f"{volume:<41}"
+                  f"{str(math.floor(free / 1000 / 1000 / 1000)) + ' GB':<12}"
+                  f"{count:<10}"
+                  f"{math.floor(quota / 1000 / 1000 / 1000)} GB")
+
+    @staticmethod
+    def _assert_cluster():
+        if not _cluster.enabled:
+            raise AdminCommandError("No cluster configured, see 'cluster_nodes' in the config file")
+
+    def _command_node_list(self):
+        self._assert_cluster()
+        allocation = User.get_node_allocation()
+        print(f"{'NODE':<21}{'HOST':<31}{'USERS':<10}{'ALLOC':<10}{'STATE'}")
+        for name, node in _cluster.nodes.items():
+            count, quota = allocation.get(name, (0, 0))
+            if name == _cluster.local_name:
+                state = 'local'
+            else:
+                state = 'reachable' if node.reachable else 'remote'
+            print(f"{name:<21}"
+                  f"{node.host:<31}"
+                  f"{count:<10}"
+                  f"{str(math.floor(quota / 1000 / 1000 / 1000)) + ' GB':<10}"
+                  f"{state}")
+
+    def _command_node_move(self):
+        self._assert_cluster()
+        user = User.get_by_name(self.args.user)
+        print(f"Moving user '{user.name}' to node {self.args.node}")
+        try:
+            user.move_to_node(self.args.node)
+        except DatabaseError as e:
+            raise AdminCommandError(e)
+        AuthorizedKeysFile(FleetView().users).save_atomic()
+        print(f"User is now stored on {_cluster.get(user.node).host}")
+
+    def _command_node_rebalance(self):
+        self._assert_cluster()
+        skipped = [name for name in _cluster.nodes if name not in _cluster.usable_names]
+        if skipped:
+            print(f"Skipping nodes whose storage is not reachable from here: {', '.join(skipped)}")
+        moves = _cluster.plan_rebalance(FleetView().users)
+        if not moves:
+            print("Nodes are balanced, nothing to move")
+            return
+        failed = 0
+        for user, src, dst in moves:
+            print(f"{user.name}: {src} -> {dst} ({user.quota_gb} GB)")
+            if self.args.apply:
+                try:
+                    User.get_by_id(user.id).move_to_node(dst)
+                except DatabaseError as e:
+                    failed += 1
+                    print(f"  {e}")
+        if not self.args.apply:
+            print(f"{len(moves)} moves planned, run with --apply to move the users")
+            return
+        AuthorizedKeysFile(FleetView().users).save_atomic()
+        if failed:
+            raise AdminCommandError(f"{failed} of {len(moves)} moves failed")
 
     def _command_line_user_show(self):
         user = User.get_by_name(self.args.name)
@@ -181,9 +479,30 @@ class AdminCommand(BaseCommand):
         notification_dispatcher = NotificationDispatcher()
         notification_dispatcher.cron()
         RepoLog.cleanup_logs()
+        UsageSample.sample_local()
+        UsageSample.compact()
+        dispatch_events()
+        MirrorState.mirror_pending()
+        TrashEntry.purge_expired()
+        Repository.apply_pending_quotas()
+        Repository.plan_backup_slots()
+
+    @staticmethod
+    def _command_broker():
+        from borgcube.frontend.broker import Broker
+        Broker().run()
+
+    @staticmethod
+    def _command_daemon():
+        from borgcube.backend.daemon import Daemon
+        Daemon().run()
 
     def run(self) -> int:
         if self.args.func:
+            # Move the serve logs written since the last admin command into the database
+            RepoLog.ingest_journal()
+            if self.args.func != self._command_fsck:
+                assert_consistent()
             self.args.func()
             return 0
         else:
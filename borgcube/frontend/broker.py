@@ -0,0 +1,99 @@
+import json
+import os
+import signal
+import socket
+import socketserver
+import struct
+import sys
+
+from borgcube.backend.config import cfg as _cfg
+from borgcube.backend.model import assert_consistent, _db
+from borgcube.enum import RemoteCommandType
+from borgcube.exception import BorgcubeError, RemoteCommandError
+from borgcube.frontend.commandline import Commandline
+from borgcube.frontend.remote_command import RemoteCommand
+
+
+class BrokerRequestHandler(socketserver.StreamRequestHandler):
+    def _check_peer(self):
+        # Only the borgcube user may ask for serve command lines
+        creds = self.request.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        _, uid, _ = struct.unpack('3i', creds)
+        if uid not in (0, os.getuid()):
+            raise RemoteCommandError(f"Connection from uid {uid} refused")
+
+    def handle(self):
+        try:
+            self._check_peer()
+            request = json.loads(self.rfile.readline())
+            reply = self.server.dispatch(request)
+        except (BorgcubeError, SystemExit) as e:
+            reply = {'error': str(e)}
+        except Exception as e:
+            # Let the client handle the connection in-process
+            reply = {'error': repr(e), 'fallback': True}
+        self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+
+class Broker(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path=None):
+        self.path = path or _cfg['broker_socket']
+        if not self.path:
+            raise BorgcubeError("broker_socket is not configured")
+        assert_consistent()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        old_umask = os.umask(0o077)
+        try:
+            super().__init__(self.path, BrokerRequestHandler)
+        finally:
+            os.umask(old_umask)
+
+    @staticmethod
+    def _command(env) -> RemoteCommand:
+        commandline = [_cfg['borgcube_executable'], 'remote', RemoteCommandType.BORGCUBE_COMMAND_BORG_SERVE.value]
+        if not Commandline.detect_remote(env, commandline):
+            raise RemoteCommandError("Not a remote connection")
+        cmd = RemoteCommand(env, commandline)
+        if not cmd.is_borg_serve:
+            raise RemoteCommandError("The broker only handles borg serve connections")
+        return cmd
+
+    def _begin(self, request) -> dict:
+        cmd = self._command(request['env'])
+        cmd.check_session()
+        transaction_id = cmd.begin_borg_session()
+        return {
+            'argv': cmd.borg_command,
+            'cwd': str(cmd.user.path),
+            'env': cmd.stripped_env,
+            'transaction_id': transaction_id,
+        }
+
+    def _end(self, request) -> dict:
+        cmd = self._command(request['env'])
+        cmd.end_borg_session(request['returncode'], request['transaction_id'])
+        return {}
+
+    def dispatch(self, request) -> dict:
+        # Every handler thread would keep its own connection open otherwise, and use up a connection pool
+        with _db.connection_context():
+            if request.get('action') == 'begin':
+                return self._begin(request)
+            elif request.get('action') == 'end':
+                return self._end(request)
+        raise RemoteCommandError(f"Unknown broker action: {request.get('action')}")
+
+    def run(self) -> int:
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        print(f"borgcube broker listening on {self.path}", flush=True)
+        try:
+            self.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.server_close()
+            os.unlink(self.path)
+        return 0
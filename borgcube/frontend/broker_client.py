@@ -0,0 +1,64 @@
+import json
+import socket
+from subprocess import Popen
+from typing import Optional
+
+from borgcube.backend.config import cfg as _cfg
+from borgcube.enum import RemoteCommandType
+from borgcube.exception import RemoteCommandError
+
+# Keep the imports of this module light. It runs for every ssh connection and should not load the database models.
+
+BROKER_ENV = ['SSH_CONNECTION', 'BORGCUBE_KEY_TYPE', 'BORGCUBE_USER', 'BORGCUBE_REPO', 'SSH_ORIGINAL_COMMAND',
+              'LOGNAME', 'SHELL']
+
+
+def broker_request(request: dict) -> dict:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(_cfg['broker_timeout'])
+        sock.connect(_cfg['broker_socket'])
+        sock.sendall(json.dumps(request).encode() + b'\n')
+        with sock.makefile('rb') as f:
+            return json.loads(f.readline())
+
+
+def _end_session_in_process(env, commandline, returncode, transaction_id):
+    from borgcube.frontend.remote_command import RemoteCommand
+    cmd = RemoteCommand(env, commandline)
+    cmd.end_borg_session(returncode, transaction_id)
+
+
+def run_via_broker(env, commandline) -> Optional[int]:
+    # Returns None if the connection has to be handled in-process by RemoteCommand
+    if not _cfg['broker_socket'] or 'SSH_ORIGINAL_COMMAND' not in env:
+        return None
+    if commandline[1:] != ['remote', RemoteCommandType.BORGCUBE_COMMAND_BORG_SERVE.value]:
+        return None
+    request_env = {key: env[key] for key in BROKER_ENV if key in env}
+    try:
+        reply = broker_request({'action': 'begin', 'env': request_env})
+    except (OSError, ValueError):
+        return None
+    if reply.get('fallback'):
+        return None
+    if 'error' in reply:
+        raise RemoteCommandError(reply['error'])
+
+    # Stay around as parent of borg serve, the session result has to be logged when it exits
+    proc = Popen(reply['argv'], cwd=reply['cwd'], env=reply['env'])
+    proc.wait()
+
+    transaction_id = reply['transaction_id']
+    end_request = {
+        'action': 'end',
+        'env': request_env,
+        'returncode': proc.returncode,
+        'transaction_id': transaction_id,
+    }
+    try:
+        reply = broker_request(end_request)
+        if reply.get('fallback') or 'error' in reply:
+            raise ValueError(reply.get('error'))
+    except (OSError, ValueError):
+        _end_session_in_process(env, commandline, proc.returncode, transaction_id)
+    return proc.returncode
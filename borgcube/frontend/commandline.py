@@ -10,14 +10,14 @@ SHELL_REMOTE_VARIABLES = ['SSH_CONNECTION', 'BORGCUBE_KEY_TYPE']
 class Commandline(object):
 
     def __init__(self, env, commandline):
-        self.is_remote = self._is_remote(env, commandline)
+        self.is_remote = self.detect_remote(env, commandline)
         if not self.is_remote:
             self.cmd = AdminCommand(env, commandline)
         else:
             self.cmd = RemoteCommand(env, commandline)
 
     @staticmethod
-    def _is_remote(env, commandline):
+    def detect_remote(env, commandline):
         error_str = "Inconsistent or incomplete environment. Can't determine if running in a remote shell or not."
         is_remote = False
         is_local = False
@@ -1,20 +1,25 @@
 from subprocess import Popen
 import argparse
+import os
 import sys
 import shlex
+from typing import List, Optional
 
+from borgcube.backend.cluster import cluster as _cluster
 from borgcube.backend.config import cfg as _cfg
-from borgcube.backend.model import User, Repository, RepoLog, LogOperation
+from borgcube.backend.model import User, Repository, RepoLog, LogOperation, assert_consistent, emit_event
 from borgcube.backend.authorized_keys import AuthorizedKeyType
+from borgcube.backend.storage import Storage
 from borgcube.frontend.base_command import BaseCommand
-from borgcube.enum import RemoteCommandType
+from borgcube.enum import RemoteCommandType, EventType
 
 from borgcube.frontend.shell import Shell
 
 from borgcube.exception import CommandEnvironmentError, \
     CommandMissingBorgcubeEnvironmentVariableError, \
     RemoteCommandError, \
-    DatabaseObjectLockedError
+    DatabaseObjectLockedError, \
+    StorageError
 
 
 class RemoteCommand(BaseCommand):
@@ -31,10 +36,10 @@ class RemoteCommand(BaseCommand):
         return parser
 
     def repo_log(self, msg):
-        RepoLog.log(self.repo, LogOperation.SERVE_REPO_LOG, str(msg))
+        RepoLog.journal(self.repo, LogOperation.SERVE_REPO_LOG, str(msg))
 
     @property
-    def _stripped_env(self):
+    def stripped_env(self):
         env = {}
         if 'SSH_ORIGINAL_COMMAND' in self.env:
             env['SSH_ORIGINAL_COMMAND'] = self.env['SSH_ORIGINAL_COMMAND']
@@ -88,13 +93,15 @@ class RemoteCommand(BaseCommand):
         if command is None:
             return None
         if command == RemoteCommandType.BORGCUBE_COMMAND_SHELL.value:
-            if 'SSH_ORIGINAL_COMMAND' in self.env:
+            if 'SSH_ORIGINAL_COMMAND' not in self.env:
+                return self._run_shell
+            argv = shlex.split(self.env['SSH_ORIGINAL_COMMAND'])
+            if argv and os.path.basename(argv[0]).startswith('borg'):
                 raise RemoteCommandError(f"Connecting via user ssh key to run borg serve is not supported. "
                                          f"Please create an appropriate repository key. "
                                          f"This is for your own safety. "
                                          f"Please also consider using different append mode and read/write keys.")
-            else:
-                return self._run_shell
+            return self._run_shell_command
         elif command == RemoteCommandType.BORGCUBE_COMMAND_BORG_SERVE.value:
             if 'SSH_ORIGINAL_COMMAND' not in self.env:
                 raise RemoteCommandError(f"You are trying to connect to borgcube shell with your repo key. This is not "
@@ -105,42 +112,77 @@ class RemoteCommand(BaseCommand):
         raise RemoteCommandError(f'Not permitted to run command: {command}. '
                                  f'Are you running this via borgcube authorized_keys file?')
 
-    def _run_borg_command(self) -> int:
+    @property
+    def borg_command(self) -> List[str]:
         command = [
             _cfg['borg_executable'],
             'serve',
             '--restrict-to-path', f'{self.repo.path}',
-            f'--storage-quota', f'{self.repo.quota_gb}G'
+            f'--storage-quota', f'{self.repo.quota}'
         ]
         if self.key_type == AuthorizedKeyType.REPO_APPEND:
             command += [
                 '--append-only'
             ]
+        return command
 
+    @property
+    def is_borg_serve(self) -> bool:
+        return self.args.command == self._run_borg_command
+
+    def begin_borg_session(self) -> Optional[int]:
+        # Returns the transaction id before the session, it needs to be passed to end_borg_session
+        transaction_id_before = self.repo.transaction_id
+        RepoLog.journal(self.repo, LogOperation.SERVE_REPO_BEGIN, " ".join(self.borg_command))
+        return transaction_id_before
+
+    def apply_pending_quota(self):
+        # A quota changed during the session can be written to the borg config now that borg serve has exited
+        quota = self.repo.get_pending_quota()
+        if quota is None:
+            return
         try:
-            transaction_id_before = self.repo.transaction_id
-            RepoLog.log(self.repo, LogOperation.SERVE_REPO_BEGIN, " ".join(command))
+            if Storage.apply_quota(self.repo, quota):
+                RepoLog.journal(self.repo, LogOperation.CHANGE_REPO_QUOTA, f"Applied {quota}")
+        except (StorageError, OSError):
+            # Left to cron
+            pass
+
+    def end_borg_session(self, returncode: int, transaction_id_before: Optional[int]):
+        self.apply_pending_quota()
+        new_transaction_id, quota_used = self.repo.session_state
+        modified = transaction_id_before and new_transaction_id and new_transaction_id > transaction_id_before
+        if quota_used is not None:
+            level = self.repo.get_quota_warning_level(quota_used)
+            if level != self.repo.quota_warning_level:
+                RepoLog.journal(self.repo, LogOperation.QUOTA_WARNING,
+                                f"{level}% ({quota_used} of {self.repo.quota} bytes used)")
+        if returncode == 0:
+            RepoLog.journal(self.repo, LogOperation.SERVE_REPO_SUCCESS, self.key_type.name)
+            if modified:
+                RepoLog.journal(self.repo, LogOperation.SERVE_MODIFY_SUCCESS, f"Transaction {new_transaction_id}")
+        else:
+            RepoLog.journal(self.repo, LogOperation.SERVE_REPO_ABORT, self.key_type.name)
+            emit_event(EventType.SERVE_REPO_ABORT, self.user, self.repo, returncode=returncode,
+                       key_type=self.key_type.name, modified=bool(modified))
+            if modified:
+                RepoLog.journal(self.repo, LogOperation.SERVE_MODIFY_ABORT, f"Transaction {new_transaction_id}")
+
+    def _run_borg_command(self) -> int:
+        try:
+            transaction_id_before = self.begin_borg_session()
 
             proc = Popen(
-                command,
+                self.borg_command,
                 stderr=sys.stderr,
                 stdout=sys.stdout,
                 stdin=sys.stdin,
                 cwd=self.user.path,
-                env=self._stripped_env
+                env=self.stripped_env
             )
 
             proc.wait()
-            new_transaction_id = self.repo.transaction_id
-
-            if proc.returncode == 0:
-                RepoLog.log(self.repo, LogOperation.SERVE_REPO_SUCCESS, self.key_type.name)
-                if transaction_id_before and new_transaction_id and new_transaction_id > transaction_id_before:
-                    RepoLog.log(self.repo, LogOperation.SERVE_MODIFY_SUCCESS, f"Transaction {new_transaction_id}")
-            else:
-                RepoLog.log(self.repo, LogOperation.SERVE_REPO_ABORT, self.key_type.name)
-                if transaction_id_before and new_transaction_id and new_transaction_id > transaction_id_before:
-                    RepoLog.log(self.repo, LogOperation.SERVE_MODIFY_ABORT, f"Transaction {new_transaction_id}")
+            self.end_borg_session(proc.returncode, transaction_id_before)
         except DatabaseObjectLockedError:
             raise RemoteCommandError("Can't start borg serve: Repository is already in use.")
         return proc.returncode
@@ -153,7 +195,22 @@ class RemoteCommand(BaseCommand):
         shell.run()
         return 0
 
+    def _run_shell_command(self) -> int:
+        if self.key_type not in [AuthorizedKeyType.USER, AuthorizedKeyType.USER_BACKUP]:
+            raise RemoteCommandError(f"You are not permitted to run borgcube shell commands with your repository keys. "
+                                     f"Please use your associated user key.")
+        shell = Shell(self)
+        return shell.run_command(shlex.split(self.env['SSH_ORIGINAL_COMMAND']))
+
+    def check_session(self):
+        # Checked before every session, in-process and by the broker
+        assert_consistent()
+        if not _cluster.is_local(self.user.node):
+            raise RemoteCommandError(f"Your backups are stored on {_cluster.get(self.user.node).host}. "
+                                     f"Please connect to that host.")
+
     def run(self) -> int:
+        self.check_session()
         if not self.args.command:
             raise CommandMissingBorgcubeEnvironmentVariableError('SSH command')
         return self.args.command()
@@ -2,13 +2,23 @@ import argparse
 # for input history functions
 import readline
 import datetime
+import io
+import json
+import math
 import sys
+from contextlib import redirect_stdout, redirect_stderr
+from typing import List
 
 import colored
 
+from borgcube.backend.cluster import cluster as _cluster
 from borgcube.backend.config import cfg
-from borgcube.backend.model import DoesNotExist, DatabaseError, Repository, User, RepoLog, AdminLog, UserLog
+from borgcube.backend.model import DoesNotExist, DatabaseError, Repository, User, RepoLog, AdminLog, UserLog, \
+    UsageSample, FleetView, emit_event
 from borgcube.backend.authorized_keys import AuthorizedKeysFile, AuthorizedKeyType
+from borgcube.backend.slots import format_time
+from borgcube.enum import EventType
+from borgcube.exception import BorgcubeError
 
 COLOR_SUCCESS = 'pale_green_3a'
 COLOR_FAIL = 'indian_red_1b'
@@ -29,6 +39,10 @@ def _echo(*args, fg=None, bg=None, attr=None):
     print(text, end='')
 
 
+def _gb(value: int) -> int:
+    return math.floor(value / 1000 / 1000 / 1000)
+
+
 def _yesno_prompt(line):
     yes = {'yes', 'y', 'ye'}
     no = {'no', 'n'}
@@ -62,6 +76,7 @@ class Shell(object):
     def __init__(self, command):
         self.cmd = command
         self.user = self.cmd.user
+        self.interactive = True
 
     def parse_connection(self):
         if self.cmd.key_type == AuthorizedKeyType.USER and self.user.backup_ssh_key:
@@ -80,6 +95,8 @@ class Shell(object):
         _echo("Visit https://github.com/felinira/borgcube/blob/master/USER_README.md to get started.\n\n")
         if self.cmd.remote_ip:
             _echo(f"You are connected from {self.cmd.remote_ip}.\n")
+        if _cluster.enabled:
+            _echo(f"Your backups are stored on {self.backup_host}, use it in your repository URLs.\n")
         _echo(f"This service is provided to you by:\n{cfg['admin_contact']}\n\n")
         self.user_quota_info()
         _echo("\n")
@@ -93,19 +110,48 @@ class Shell(object):
     @staticmethod
     def usage(parser, args):
         parser.print_usage()
+        return parser.format_usage()
 
     @staticmethod
     def help(parser, args):
         parser.print_help()
+        return parser.format_help()
 
     @staticmethod
     def exit(parser, args):
         raise ShellExit()
 
+    @property
+    def backup_host(self):
+        return _cluster.get(self.user.node).host if _cluster.enabled else None
+
     def user_quota_info(self):
         _echo(f"Quota used: {self.user.quota_used_gb}GB / {self.user.quota_gb}GB\n")
+        _echo(f"Disk used: {self.user.disk_usage_gb}GB\n")
         _echo(f"Quota alloc: {self.user.quota_allocated_gb}GB / {self.user.quota_gb}GB\n")
 
+    @staticmethod
+    def _date(date):
+        return date.isoformat() if date else None
+
+    @staticmethod
+    def _repo_usage(repos) -> dict:
+        # (quota used, disk usage) by repo id, the disk usage of all repos comes from one scan
+        disk_usage = Repository.get_disk_usage(repos)
+        return {repo.id: (repo.quota_used, disk_usage[repo.id]) for repo in repos}
+
+    def _repo_dict(self, repo, usage: tuple = None):
+        result = {
+            'name': repo.name,
+            'quota': repo.quota,
+            'creation_date': self._date(repo.creation_date),
+            'last_date': self._date(repo.last_date),
+            'notification_days': repo.max_age.days,
+        }
+        if usage:
+            result['quota_used'], result['disk_usage'] = usage
+        return result
+
     def user_info(self, parser, args):
         _echo(f"You are logged in as {self.user.name}\n")
         _echo(f"Email: {self.user.email}\n")
@@ -115,7 +161,19 @@ class Shell(object):
             _echo(f" (unverified)\n")
             _echo(f"Backup user key: {self.user.backup_ssh_key}")
         _echo(f"\nRepos: {len(self.user.repos)} / {self.user.max_repo_count}\n")
+        if _cluster.enabled:
+            _echo(f"Backup host: {self.backup_host}\n")
         self.user_quota_info()
+        return {
+            'name': self.user.name,
+            'email': self.user.email,
+            'host': self.backup_host,
+            'repos': len(self.user.repos),
+            'max_repo_count': self.user.max_repo_count,
+            'quota': self.user.quota,
+            'quota_used': self.user.quota_used,
+            'quota_allocated': self.user.quota_allocated,
+        }
 
     def user_key_delete_backup(self):
         self.user.backup_ssh_key = None
@@ -133,6 +191,10 @@ class Shell(object):
             _echo("You have set a new key but didn't log in with it yet. Please log in once with your new key to "
                   "purge your old key.", fg=COLOR_FAIL)
         _echo("\n")
+        return {
+            'key': self.user.ssh_key.keydata if self.user.ssh_key else None,
+            'backup_key': self.user.backup_ssh_key.keydata if self.user.backup_ssh_key else None,
+        }
 
     def user_key_set(self, parser, args):
         if len(args.key) == 0:
@@ -150,8 +212,9 @@ class Shell(object):
                 _echo(f"Successfully cleared ssh user key\n", fg=COLOR_SUCCESS)
         except DatabaseError as e:
             raise ShellCommandError(f"Can't set key: {e}\n")
-        authorized_keys_file = AuthorizedKeysFile(User.get_all())
+        authorized_keys_file = AuthorizedKeysFile(FleetView().users)
         authorized_keys_file.save_atomic()
+        return {'key': key}
 
     def repo_show(self, parser, args):
         repo = args.repo
@@ -161,29 +224,66 @@ class Shell(object):
         if repo.last_date:
             _echo(f"Last Accessed: {repo.last_date.ctime()}\n")
         _echo(f"Locked: {repo.locked}\n")
-        self.repo_quota(parser, args)
+        result = self.repo_quota(parser, args)
+        result['locked'] = repo.locked != 0
+        return result
 
     def repo_list(self, parser, args):
-        _echo(f"Repos: {len(self.user.repos)} / {self.user.max_repo_count}\n")
-        if len(self.user.repos) > 0:
-            _echo(f"{'REPO':<21}{'USAGE':<10}{'QUOTA'}\n")
-            for repo in self.user.repos:
-                _echo(f"{repo.name:<21}{(str(repo.quota_used_gb) + ' GB'):<10}{repo.quota_gb} GB\n")
+        repos = list(self.user.repos)
+        _echo(f"Repos: {len(repos)} / {self.user.max_repo_count}\n")
+        usage = self._repo_usage(repos)
+        if len(repos) > 0:
+            _echo(f"{'REPO':<21}{'USAGE':<10}{'DISK':<10}{'QUOTA'}\n")
+            for repo in repos:
+                quota_used, disk_usage = usage[repo.id]
+                _echo(f"{repo.name:<21}{(str(_gb(quota_used)) + ' GB'):<10}"
+                      f"{(str(_gb(disk_usage)) + ' GB'):<10}{repo.quota_gb} GB\n")
+        return [self._repo_dict(repo, usage[repo.id]) for repo in repos]
 
     def repo_quota(self, parser, args):
         if args.new_quota is not None:
             return self.repo_quota_set(parser, args)
-        _echo(f"Storage used: {(str(args.repo.quota_used_gb) + ' GB')} / {args.repo.quota_gb} GB\n")
+        usage = self._repo_usage([args.repo])[args.repo.id]
+        _echo(f"Storage used: {(str(_gb(usage[0])) + ' GB')} / {args.repo.quota_gb} GB\n")
+        _echo(f"Disk used: {_gb(usage[1])} GB\n")
         _echo(f"You can change quota with 'repo quota {args.repo.name} <size in GB>'\n")
+        return self._repo_dict(args.repo, usage)
 
     def repo_quota_set(self, parser, args):
         if args.new_quota < 1:
             raise ShellCommandError(f"Quota must be 1GB or more")
+        old_quota = args.repo.quota
         try:
             args.repo.quota_gb = args.new_quota
+            emit_event(EventType.REPO_QUOTA_CHANGED, self.user, args.repo, old_quota=old_quota, quota=args.repo.quota)
             _echo(f"Changed repo quota to {args.repo.quota_gb} GB\n", fg=COLOR_SUCCESS)
         except DatabaseError as e:
             raise ShellCommandError(f'{e}')
+        return self._repo_dict(args.repo)
+
+    def repo_usage(self, parser, args):
+        repo = args.repo
+        usage = self._repo_usage([repo])[repo.id]
+        _echo(f"Storage used: {(str(_gb(usage[0])) + ' GB')} / {repo.quota_gb} GB\n")
+        result = self._repo_dict(repo, usage)
+        trend = repo.usage_trend
+        if trend is None or trend.samples < 2:
+            _echo("Not enough usage samples for a forecast yet\n")
+        else:
+            _echo(f"Growth: {trend.bytes_per_day / 1000 / 1000 / 1000:.2f} GB per day\n")
+            days_until = trend.days_until(repo.quota)
+            result['bytes_per_day'] = trend.bytes_per_day
+            result['days_until_full'] = days_until
+            if days_until is not None:
+                _echo(f"Quota will be reached in about {days_until:.0f} days\n")
+        if args.history:
+            _echo(f"\n{'DATE':<21}{'USAGE'}\n")
+            result['history'] = []
+            for sample in UsageSample.get_history(repo):
+                date = datetime.datetime.fromtimestamp(sample.timestamp)
+                result['history'].append({'date': date.isoformat(), 'bytes_used': sample.bytes_used})
+                _echo(f"{date.strftime('%Y-%m-%d %H:%M'):<21}{sample.bytes_used / 1000 / 1000 / 1000:.2f} GB\n")
+        return result
 
     def repo_create(self, parser, args):
         try:
@@ -191,16 +291,26 @@ class Shell(object):
             _echo(f"Created repository with name {repo.name}\n", fg=COLOR_SUCCESS)
         except DatabaseError as e:
             raise ShellCommandError(f"Can't create repository '{args.name}': {e}")
+        return self._repo_dict(repo)
 
     def repo_del(self, parser, args):
         if not args.repo:
             raise ShellCommandError(f"Can't delete repository because it does not exist")
+        if args.confirm is not None and args.confirm != 'CONFIRM':
+            raise ShellCommandError(f"Append CONFIRM to delete repository '{args.repo.name}'")
+        if args.confirm is None and not self.interactive:
+            raise ShellCommandError(f"Append CONFIRM to delete repository '{args.repo.name}' and all backup contents")
         try:
-            if _yesno_prompt(f"Do you want to delete your repo '{args.repo.name}' and all backup contents? [Y/N] "):
+            if args.confirm or _yesno_prompt(f"Do you want to delete your repo '{args.repo.name}' and all backup "
+                                             f"contents? [Y/N] "):
                 args.repo.delete_instance()
                 _echo(f"Deleted repo '{args.repo.name}'\n", fg=COLOR_SUCCESS)
+                if cfg['trash_grace_days']:
+                    _echo(f"Contact {cfg['admin_contact']} within {cfg['trash_grace_days']} days to restore it.\n")
+                return {'name': args.repo.name, 'deleted': True}
         except DatabaseError as e:
             raise ShellCommandError(f"Can't delete repository '{args.repo.name}': {e}")
+        return {'name': args.repo.name, 'deleted': False}
 
     def repo_keys_show(self, parser, args):
         _echo(f"Append SSH key:\n")
@@ -214,6 +324,10 @@ class Shell(object):
         else:
             _echo("<missing>")
         _echo("\n")
+        return {
+            'append_key': args.repo.append_ssh_key.keydata if args.repo.append_ssh_key else None,
+            'rw_key': args.repo.rw_ssh_key.keydata if args.repo.rw_ssh_key else None,
+        }
 
     def repo_key_set(self, parser, args):
         if len(args.key) == 0:
@@ -248,29 +362,60 @@ class Shell(object):
                 _echo(f"Successfully cleared {args.key_type} key of '{args.repo.name}'\n", fg=COLOR_SUCCESS)
         except DatabaseError as e:
             raise ShellCommandError(f"Can't set key: {e}")
-        authorized_keys_file = AuthorizedKeysFile(User.get_all())
+        authorized_keys_file = AuthorizedKeysFile(FleetView().users)
         authorized_keys_file.save_atomic()
+        return {'name': args.repo.name, 'key_type': args.key_type, 'key': key}
 
     def repo_notification_set(self, parser, args):
         try:
-            args.repo.max_age = datetime.timedelta(days=args.days)
-            args.repo.save()
+            args.repo.set_max_age(datetime.timedelta(days=args.days))
             _echo(f"Successfully set repository '{args.repo.name}' notification time "
                   f"to {args.days} days\n", fg=COLOR_SUCCESS)
         except DatabaseError as e:
             raise ShellCommandError(f"Can't set repository notification time: {e}")
+        return self._repo_dict(args.repo)
 
     def _do_repo_notification(self, repo):
         _echo(f"Repository '{repo.name}' has notifications set to fire after '{repo.max_age.days}' days\n")
 
     def repo_notification(self, parser, args):
         if not args.repo:
-            for repo in Repository.get_all_by_user(self.user):
+            repos = list(Repository.get_all_by_user(self.user))
+            for repo in repos:
                 self._do_repo_notification(repo)
-            return
+            return [{'name': repo.name, 'notification_days': repo.max_age.days} for repo in repos]
         if args.days is not None:
             return self.repo_notification_set(parser, args)
         self._do_repo_notification(args.repo)
+        return {'name': args.repo.name, 'notification_days': args.repo.max_age.days}
+
+    def repo_schedule(self, parser, args):
+        repos = [args.repo] if args.repo else list(Repository.get_all_by_user(self.user))
+        durations = RepoLog.get_session_durations([repo.id for repo in repos])
+        now = datetime.datetime.now().astimezone()
+        result = []
+        for repo in repos:
+            duration = durations.get(repo.id)
+            # Slots, cron and window are in the server's local time, the UTC values are for clients in other zones
+            entry = {'name': repo.name, 'slot': None, 'cron': None, 'slot_utc': None, 'cron_utc': None,
+                     'expected_duration': duration, 'window': cfg['schedule_window'], 'timezone': now.tzname(),
+                     'utc_offset': now.strftime('%z')}
+            if repo.backup_slot is None:
+                _echo(f"Repository '{repo.name}' has no backup slot yet, slots are planned once a day\n")
+            else:
+                slot = now.replace(hour=repo.backup_slot // 60, minute=repo.backup_slot % 60, second=0, microsecond=0)
+                utc = slot.astimezone(datetime.timezone.utc)
+                entry['slot'] = format_time(repo.backup_slot)
+                entry['cron'] = f"{repo.backup_slot % 60} {repo.backup_slot // 60} * * *"
+                entry['slot_utc'] = utc.strftime('%H:%M')
+                entry['cron_utc'] = f"{utc.minute} {utc.hour} * * *"
+                _echo(f"Repository '{repo.name}': start backups at {entry['slot']} server time ({now.tzname()}, "
+                      f"{entry['slot_utc']} UTC)")
+                if duration is not None:
+                    _echo(f", they take about {math.ceil(duration / 60)} minutes")
+                _echo("\n")
+            result.append(entry)
+        return result[0] if args.repo else result
 
     def repo_logs(self, parser, args):
         if args.repo:
@@ -279,6 +424,7 @@ class Shell(object):
             lines = RepoLog.format_logs_for_user(self.user)
         for line in lines:
             _echo(line + "\n")
+        return lines
 
     def argparse_repo(self, repo_name):
         try:
@@ -317,6 +463,9 @@ class Shell(object):
         parse_repo.set_defaults(func=self.repo_list, new_quota=None)
 
         repo_subparsers = parse_repo.add_subparsers(required=False)
+        parse_repo_list = repo_subparsers.add_parser('list', help='list repos')
+        parse_repo_list.set_defaults(func=self.repo_list)
+
         parse_repo_show = repo_subparsers.add_parser('show', help='show repo information')
         parse_repo_show.add_argument('repo', type=self.argparse_repo, help='name of the repository')
         parse_repo_show.set_defaults(func=self.repo_show)
@@ -330,6 +479,11 @@ class Shell(object):
         parse_repo_quota.add_argument('repo', type=self.argparse_repo, help='name of the repository')
         parse_repo_quota.add_argument('new_quota', nargs='?', type=int, help='value to set the repo quota to')
 
+        parse_repo_usage = repo_subparsers.add_parser('usage', help='show usage growth and forecast')
+        parse_repo_usage.add_argument('repo', type=self.argparse_repo, help='name of the repository')
+        parse_repo_usage.add_argument('--history', action='store_true', help='list all usage samples')
+        parse_repo_usage.set_defaults(func=self.repo_usage)
+
         parse_repo_create = repo_subparsers.add_parser('create', help='create repo')
         parse_repo_create.add_argument('name', help='name of the new repository')
         parse_repo_create.add_argument('quota', type=int, help='repository quota')
@@ -337,6 +491,7 @@ class Shell(object):
 
         parse_repo_delete = repo_subparsers.add_parser('delete', help='delete repo')
         parse_repo_delete.add_argument('repo', type=self.argparse_repo, help='repository name')
+        parse_repo_delete.add_argument('confirm', nargs='?', help='CONFIRM to delete without asking')
         parse_repo_delete.set_defaults(func=self.repo_del)
 
         parse_repo_keys = repo_subparsers.add_parser('keys', help='get or set ssh key')
@@ -359,6 +514,10 @@ class Shell(object):
         parse_repo_notification.add_argument('days', nargs="?", type=int, help='Days after which to send notification')
         parse_repo_notification.set_defaults(repo=None, func=self.repo_notification)
 
+        parse_repo_schedule = repo_subparsers.add_parser('schedule', help='show the planned start time of backups')
+        parse_repo_schedule.add_argument('repo', nargs="?", type=self.argparse_repo, help='repository name')
+        parse_repo_schedule.set_defaults(func=self.repo_schedule)
+
         return parser
 
     def loop(self):
@@ -389,6 +548,43 @@ class Shell(object):
                 _echo("\nBye\n")
                 break
 
+    def run_command(self, argv: List[str]) -> int:
+        # Runs a single command, e.g. 'ssh borg@server repo list --json'. No banner, no prompts.
+        self.interactive = False
+        json_output = '--json' in argv
+        argv = [arg for arg in argv if arg != '--json']
+        parser = self.get_parser()
+        result = None
+        error = None
+        returncode = 0
+        output = io.StringIO()
+        try:
+            if json_output:
+                with redirect_stdout(output), redirect_stderr(output):
+                    self.parse_connection()
+                    args = parser.parse_args(argv)
+                    result = args.func(parser, args)
+            else:
+                self.parse_connection()
+                args = parser.parse_args(argv)
+                args.func(parser, args)
+        except SystemExit as e:
+            # argparse exits on --help and on invalid arguments
+            returncode = e.code or 0
+            if returncode:
+                error = output.getvalue().strip().splitlines()[-1] if output.getvalue().strip() else 'invalid command'
+        except (ShellCommandError, ShellError, BorgcubeError) as e:
+            # BorgcubeError e.g. from reading the usage of a repo with broken storage
+            returncode = 1
+            error = str(e)
+            if not json_output:
+                print(f"Error: {e}", file=sys.stderr)
+        except ShellExit:
+            pass
+        if json_output:
+            print(json.dumps({'ok': returncode == 0, 'result': result, 'error': error}))
+        return returncode
+
     def run(self):
         try:
             self.parse_connection()
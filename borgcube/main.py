@@ -35,6 +35,12 @@ def main():
     try:
         drop_privileges()
 
+        # borg serve connections are answered by the broker if it is running. Only load everything else if it isn't.
+        from borgcube.frontend.broker_client import run_via_broker
+        ret = run_via_broker(os.environ.copy(), sys.argv)
+        if ret is not None:
+            exit(ret)
+
         from borgcube.frontend.commandline import Commandline
         cmd = Commandline(os.environ.copy(), sys.argv)
         ret = cmd.run()